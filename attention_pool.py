@@ -1,14 +1,39 @@
 import torch
 import torch.nn as nn
 
+def weighted_sum(weight, samples, class_num, efficient=True):
+    query_dim = int(weight.shape[0])
+    sample_dim = int(samples.shape[0]) // class_num
+
+    if efficient:
+        # The support set is shared by all query windows, contract it per class without copying it
+        weight = weight.reshape(query_dim, class_num, sample_dim)                 # [query*class*window, class, sample*window]
+        samples = samples.reshape(class_num, sample_dim, -1)                      # [class, sample*window, clip*feature]
+        samples = torch.einsum("qcs,csf->qcf", weight, samples)                   # [query*class*window, class, clip*feature]
+        return samples.reshape(query_dim*class_num, -1)
+
+    weight = weight.reshape(query_dim*class_num, sample_dim).unsqueeze(1)         # [query*class*window*class, 1, sample*window]
+    samples = samples.unsqueeze(0).repeat(query_dim,1,1,1).reshape(query_dim*class_num, sample_dim, -1) # [query*class*window*class, sample*window, clip*feature]
+    return torch.bmm(weight, samples).squeeze(1)                                  # [query*class*window*class, clip*feature]
+
+def episode_weighted_sum(weight, samples, class_num):
+    # Same as weighted_sum for E episodes stacked along the first dimension, shapes are kept as tensors so that it traces
+    # with a dynamic number of episodes and queries
+    weight = weight.reshape(weight.shape[0], weight.shape[1], class_num, -1)      # [episode, query*class*window, class, sample*window]
+    samples = samples.reshape(samples.shape[0], class_num, weight.shape[3], -1)   # [episode, class, sample*window, clip*feature]
+    samples = torch.einsum("eqcs,ecsf->eqcf", weight, samples)                    # [episode, query*class*window, class, clip*feature]
+    return samples.reshape(-1, samples.shape[3])
+
 class AttentionPooling(nn.Module):
-    def __init__(self, class_num, sample_num, query_num, window_num, clip_num, feature_dim):
+    def __init__(self, class_num, sample_num, query_num, window_num, clip_num, feature_dim, efficient=True, chunk_size=None):
         super(AttentionPooling, self).__init__()
         self.class_num = class_num
         self.sample_num = sample_num
         self.window_num = window_num
         self.clip_num = clip_num
         self.feature_dim = feature_dim
+        self.efficient = efficient
+        self.chunk_size = chunk_size
         # self.k = k
 
         self.query_dim = class_num*query_num*window_num
@@ -39,6 +64,12 @@ class AttentionPooling(nn.Module):
         nn.init.kaiming_normal_(self.layer2[3].weight)
 
     def forward(self, samples, batches):
+        # Batch norms use running statistics outside training, so query windows can be pooled chunk by chunk
+        if self.chunk_size is None or self.training or int(batches.shape[0]) <= self.chunk_size:
+            return self.pool(samples, batches)
+        return torch.cat([self.pool(samples, chunk) for chunk in torch.split(batches, self.chunk_size)], 0)
+
+    def pool(self, samples, batches):
         self.query_dim = int(batches.shape[0])
 
         samples_trans = torch.transpose(samples, 0, 1)    # [clip, class*sample*window, feature]
@@ -54,24 +85,47 @@ class AttentionPooling(nn.Module):
         #     weight_01 = weight.new_full((self.query_dim, self.class_num, self.sample_num*self.window_num), 0, requires_grad=True) # [query*class*window, class, sample*window]
         #     weight = weight_01.scatter_(2, topk_idx, 1)
 
-        weight = weight.reshape(self.query_dim*self.class_num, self.sample_num*self.window_num).unsqueeze(1) # [query*class*window*class, 1, sample*window]
-
-        samples = samples.unsqueeze(0).repeat(self.query_dim,1,1,1).reshape(self.query_dim*self.class_num, self.sample_num*self.window_num, -1) # [query*class*window*class, sample*window, clip*feature]
-        samples = torch.bmm(weight, samples).squeeze(1)                        # [query*class*window*class, clip*feature]
+        samples = weighted_sum(weight, samples, self.class_num, self.efficient)  # [query*class*window*class, clip*feature]
 
         samples = self.layer2(samples)                                         # [query*class*window*class, clip*feature]
         samples = samples.reshape(self.query_dim, self.class_num, self.clip_num, -1)  # [query*class*window, class, clip, feature]
 
         return samples
 
+    def forward_episodes(self, samples, batches):
+        '''
+        Pools E episodes at once, weights only mix the support of their own episode
+        param:samples   shape [episode, class*sample*window, clip, feature]
+        param:batches   shape [episode, query*class*window, clip, feature]
+        return:         shape [episode, query*class*window, class, clip, feature]
+        '''
+        if int(batches.shape[0]) == 1:
+            return self.forward(samples[0], batches[0]).unsqueeze(0)
+        self.query_dim = int(batches.shape[1])
+        return self.pool_episodes(samples, batches)
+
+    def pool_episodes(self, samples, batches):
+        # forward_episodes without the single episode path, no shape is turned into an int so that exported graphs
+        # keep the episode and query axes dynamic
+        weight = torch.einsum("eqcf,escf->eqs", batches, samples)             # [episode, query*class*window, class*sample*window]
+        weight = self.layer1(weight.reshape(-1, weight.shape[2])).reshape(weight.shape)
+
+        samples = episode_weighted_sum(weight, samples, self.class_num)         # [episode*query*class*window*class, clip*feature]
+        samples = self.layer2(samples)
+        samples = samples.reshape(weight.shape[0], weight.shape[1], self.class_num, self.clip_num, -1)  # [episode, query*class*window, class, clip, feature]
+
+        return samples
+
 class AttentionPoolingConv(nn.Module):
-    def __init__(self, class_num, sample_num, query_num, window_num, clip_num, feature_dim):
+    def __init__(self, class_num, sample_num, query_num, window_num, clip_num, feature_dim, efficient=True, chunk_size=None):
         super(AttentionPoolingConv, self).__init__()
         self.class_num = class_num
         self.sample_num = sample_num
         self.window_num = window_num
         self.clip_num = clip_num
         self.feature_dim = feature_dim
+        self.efficient = efficient
+        self.chunk_size = chunk_size
         # self.k = k
 
         self.query_dim = class_num*query_num*window_num
@@ -92,6 +146,12 @@ class AttentionPoolingConv(nn.Module):
         nn.init.kaiming_normal_(self.layer[3].weight)
 
     def forward(self, samples, batches):
+        # Batch norms use running statistics outside training, so query windows can be pooled chunk by chunk
+        if self.chunk_size is None or self.training or int(batches.shape[0]) <= self.chunk_size:
+            return self.pool(samples, batches)
+        return torch.cat([self.pool(samples, chunk) for chunk in torch.split(batches, self.chunk_size)], 0)
+
+    def pool(self, samples, batches):
         self.query_dim = int(batches.shape[0])
 
         samples_trans = torch.transpose(samples, 0, 1)    # [clip, class*sample*window, feature]
@@ -101,12 +161,25 @@ class AttentionPoolingConv(nn.Module):
         weight = weight.unsqueeze(1) # [query*class*window, 1, class*sample*window]
         weight = self.layer(weight)
 
-        weight = weight.reshape(self.query_dim*self.class_num, self.sample_num*self.window_num).unsqueeze(1) # [query*class*window*class, 1, sample*window]
-
-        samples = samples.unsqueeze(0).repeat(self.query_dim,1,1,1).reshape(self.query_dim*self.class_num, self.sample_num*self.window_num, -1) # [query*class*window*class, sample*window, clip*feature]
-        samples = torch.bmm(weight, samples).squeeze(1)                        # [query*class*window*class, clip*feature]
+        samples = weighted_sum(weight, samples, self.class_num, self.efficient)  # [query*class*window*class, clip*feature]
 
         samples = samples.reshape(self.query_dim, self.class_num, self.clip_num, -1)  # [query*class*window, class, clip, feature]
 
         return samples
 
+    def forward_episodes(self, samples, batches):
+        # See AttentionPooling.forward_episodes
+        if int(batches.shape[0]) == 1:
+            return self.forward(samples[0], batches[0]).unsqueeze(0)
+        self.query_dim = int(batches.shape[1])
+        return self.pool_episodes(samples, batches)
+
+    def pool_episodes(self, samples, batches):
+        # See AttentionPooling.pool_episodes
+        weight = torch.einsum("eqcf,escf->eqs", batches, samples)             # [episode, query*class*window, class*sample*window]
+        weight = self.layer(weight.reshape(-1, 1, weight.shape[2])).reshape(weight.shape)
+
+        samples = episode_weighted_sum(weight, samples, self.class_num)         # [episode*query*class*window*class, clip*feature]
+        samples = samples.reshape(weight.shape[0], weight.shape[1], self.class_num, self.clip_num, -1)  # [episode, query*class*window, class, clip, feature]
+
+        return samples
@@ -0,0 +1,208 @@
+# Public Packages
+import torch                                         #  Torch
+import torch.nn as nn                                #
+
+import numpy as np                                   #  Numpy
+
+import argparse                                      #
+import collections                                   #
+import copy                                          #
+import json                                          #  OS
+import os                                            #
+import random                                        #
+import time                                          #
+
+# Private Packages
+from pipeline import FewShotPipeline, build_pipeline_models, load_pipeline_models, QUERY_NUM
+from frame_store import FrameStore
+from video_index import load_video_index, index_path
+from utils import EpisodeSplitSchedule, normalize_clips, episode_splits, stack_splits, ctc_predict_single
+import dataset
+
+# Speed and accuracy of the models of train.py and test.py in float32 and under bfloat16 autocast, with C3D in the
+# default NCDHW layout and in channels_last_3d:
+#   inference   clips/s of FewShotPipeline in eval mode, encoding, pooling and relation of whole episodes
+#   latency     ms of C3D in eval mode on a single clip
+#   training    clips/s of a forward pass, the CTC loss and the backward pass of train.py, without the optimizer
+#   accuracy    of every variant on the same test episodes and splits of a dataset, or without one, the agreement
+#               of their predictions with fp32 on random clips
+# The models are random unless a checkpoint is given, which only matters for the accuracy.
+
+# Variant -> (precision, channels_last)
+VARIANTS = collections.OrderedDict([("fp32", ("fp32", False)), ("bf16", ("bf16", False)),
+                                    ("fp32_channels_last", ("fp32", True)), ("bf16_channels_last", ("bf16", True))])
+
+def autocast(precision, device):
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+def random_clips(video_num, config, generator=None):
+    # uint8 clips [video, window*clip, RGB, frame, H, W]
+    return torch.randint(0, 256, (video_num, config["window_num"]*config["clip_num"], 3, config["frame_num"], config["frame_size"], config["frame_size"]),
+                         dtype=torch.uint8, generator=generator)
+
+def random_episodes(episode_num, config, generator=None):
+    # Clips, labels and stacked splits of <episode_num> episodes
+    class_num, sample_num = config["way"], config["shot"]
+    episode_size = class_num*(sample_num+QUERY_NUM)
+    data = random_clips(episode_num*episode_size, config, generator)
+    data_labels = torch.cat([dataset.episode_labels(torch.arange(class_num).repeat_interleave(sample_num+QUERY_NUM)) for _ in range(episode_num)])
+    support_index, query_index = episode_splits(episode_num, class_num, sample_num, QUERY_NUM, generator)
+    support_index, query_index = stack_splits(list(zip(support_index, query_index)), episode_size)
+    return data, data_labels, support_index, query_index
+
+def inference_step(pipeline, precision, device):
+    def step(data, data_labels, support_index, query_index):
+        with torch.no_grad(), autocast(precision, device):
+            pipeline(data, support_index, query_index)
+    return step
+
+def training_step(pipeline, precision, device):
+    # Loss of train.py, the relations are cast back to float32 before the softmax and the CTC loss
+    ctc = nn.CTCLoss()
+    def step(data, data_labels, support_index, query_index):
+        with autocast(precision, device):
+            relations, _ = pipeline(data, support_index, query_index)  # [episode*query*class, window, class]
+        relations_ctc = torch.cat((torch.ones_like(relations[:, :, :1]), relations), 2)
+        final_outcome = torch.transpose(nn.functional.log_softmax(relations_ctc, 2), 0, 1)  # [window(length), episode*query*class, class+1]
+        batches_labels = data_labels[query_index].to(device)
+        input_lengths = torch.full(size=(len(query_index),), fill_value=pipeline.window_num, dtype=torch.long)
+        target_lengths = torch.full(size=(len(query_index),), fill_value=1, dtype=torch.long)
+        pipeline.zero_grad()
+        ctc(final_outcome, batches_labels, input_lengths, target_lengths).backward()
+    return step
+
+def latency(encoder, precision, device, clip, repeat, warmup=1):
+    # Median ms of <encoder> on one clip [1, RGB, frame, H, W]
+    times = []
+    with torch.no_grad(), autocast(precision, device):
+        for n in range(warmup + repeat):
+            start = time.time()
+            encoder(clip)
+            if n >= warmup:
+                times.append(time.time() - start)
+    return 1000 * float(np.median(times))
+
+def throughput(step, inputs, repeat, warmup=1):
+    # Clips per second of <step> on <inputs>, after <warmup> untimed calls
+    data = inputs[0]
+    for _ in range(warmup):
+        step(*inputs)
+    start = time.time()
+    for _ in range(repeat):
+        step(*inputs)
+    return repeat * data.shape[0] * data.shape[1] / (time.time() - start)
+
+def predict(pipeline, precision, device, data, support_index, query_index):
+    with torch.no_grad(), autocast(precision, device):
+        relations, final_outcome = pipeline(data.to(device), support_index.to(device), query_index.to(device))
+    return ctc_predict_single(final_outcome), final_outcome
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", help="path of the dataset json file, accuracy is measured on its test split, on random clips if not specified")
+    parser.add_argument("-c", "--checkpoint", help="path of the checkpoint to benchmark, random weights if not specified")
+    parser.add_argument("-w", "--way", help="number of classes", type=int, default=3)
+    parser.add_argument("-s", "--shot", help="number of shots", type=int, default=5)
+    parser.add_argument("--frame_size", help="height and width of the input frames", type=int, default=128)
+    parser.add_argument("--frame_num", help="number of frames per clip", type=int, default=10)
+    parser.add_argument("--clip_num", help="number of clips per window", type=int, default=5)
+    parser.add_argument("--window_num", help="number of windows per video", type=int, default=3)
+    parser.add_argument("--head", help="head between the encoder and the TCN", choices=["flatten", "avg", "bottleneck"], default="flatten")
+    parser.add_argument("--relation", help="relation between pooled support and query, cos is what test.py scores with", choices=["rn", "cos"], default="cos")
+    parser.add_argument("--frame_store", help="path of a frame store packed by frame_store.py, decode jpgs if not specified")
+    parser.add_argument("--episodes", help="number of episodes stacked into one timed pass", type=int, default=1)
+    parser.add_argument("--repeat", help="number of timed passes per variant", type=int, default=10)
+    parser.add_argument("--test_ep", help="number of episodes the accuracy is measured on", type=int, default=20)
+    parser.add_argument("--seed", help="seed of the random clips, the test episodes and their splits", type=int, default=0)
+    parser.add_argument("--threads", help="number of intra-op threads, torch's default if not specified", type=int)
+    parser.add_argument("--skip_training", help="whether to only benchmark inference", action="store_true")
+    parser.add_argument("--variants", help="precisions and C3D layouts to compare, fp32 is always run as the reference", nargs="+", choices=list(VARIANTS), default=list(VARIANTS))
+    args = parser.parse_args()
+
+    if args.dataset is not None and not os.path.exists(args.dataset):
+        raise Exception("invalid dataset path: {}".format(args.dataset))
+    if args.checkpoint is not None and not os.path.exists(args.checkpoint):
+        raise Exception("invalid checkpoint path: {}".format(args.checkpoint))
+    if args.episodes <= 0 or args.repeat <= 0 or args.test_ep <= 0:
+        raise Exception("episodes, repeats and test episodes must be positive")
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    config = {"way": args.way, "shot": args.shot, "frame_size": args.frame_size, "frame_num": args.frame_num,
+              "clip_num": args.clip_num, "window_num": args.window_num, "head": args.head, "relation": args.relation}
+    models = (args.way, args.shot, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.head)
+    variants = ["fp32"] + [variant for variant in args.variants if variant != "fp32"]
+    torch.manual_seed(args.seed)
+    c3d, tcn, ap, rn = load_pipeline_models(args.checkpoint, *models) if args.checkpoint is not None else build_pipeline_models(*models)
+    pipelines = {False: FewShotPipeline(c3d, tcn, ap, rn, args.way, args.shot, QUERY_NUM, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.relation).to(device)}
+    if any(VARIANTS[variant][1] for variant in variants):
+        # Same weights, with C3D converted to channels_last_3d
+        c3d, tcn, ap, rn = build_pipeline_models(*models, channels_last=True)
+        pipelines[True] = FewShotPipeline(c3d, tcn, ap, rn, args.way, args.shot, QUERY_NUM, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.relation).to(device)
+        pipelines[True].load_state_dict(pipelines[False].state_dict())
+    print("Benchmark {} on {} with {} threads".format(json.dumps(config), device, torch.get_num_threads()))
+
+    # Speed, the same episodes and clip for all variants, the training steps update the batch norm statistics, which are restored after
+    state = copy.deepcopy(pipelines[False].state_dict())
+    generator = torch.Generator().manual_seed(args.seed)
+    data, data_labels, support_index, query_index = random_episodes(args.episodes, config, generator)
+    inputs = (data.to(device), data_labels, support_index.to(device), query_index.to(device))
+    clip = normalize_clips(data[:1, 0]).to(device)   # [1, RGB, frame, H, W]
+    speeds = {}
+    for variant in variants:
+        precision, channels_last = VARIANTS[variant]
+        pipeline = pipelines[channels_last]
+        speeds[variant] = {"inference": throughput(inference_step(pipeline.eval(), precision, device), inputs, args.repeat),
+                           "latency": latency(pipeline.c3d, precision, device, clip, args.repeat)}
+        if not args.skip_training:
+            speeds[variant]["training"] = throughput(training_step(pipeline.train(), precision, device), inputs, args.repeat)
+            pipeline.zero_grad(set_to_none=True)
+        pipeline.eval()
+    for pipeline in pipelines.values():
+        pipeline.load_state_dict(state)
+    for variant in variants:
+        print("{} inference = {:.1f} clips/s ({:.2f}x), latency = {:.2f} ms/clip ({:.2f}x)".format(
+            variant, speeds[variant]["inference"], speeds[variant]["inference"]/speeds["fp32"]["inference"],
+            speeds[variant]["latency"], speeds["fp32"]["latency"]/speeds[variant]["latency"]), end="")
+        if not args.skip_training:
+            print(", training = {:.1f} clips/s ({:.2f}x)".format(speeds[variant]["training"], speeds[variant]["training"]/speeds["fp32"]["training"]), end="")
+        print()
+
+    # Accuracy on fixed test episodes, or agreement on random clips
+    if args.dataset is not None:
+        with open(args.dataset, "r") as file:
+            dataset_info = json.loads(file.readline())
+        frame_store = FrameStore(args.frame_store) if args.frame_store is not None else None
+        test_dataset = dataset.get_video_dataset(dataset_info, "test", load_video_index(index_path(args.dataset), dataset_info), args.frame_num, args.clip_num,
+                                                 args.window_num, args.shot+QUERY_NUM, frame_store, False, args.frame_size)
+        random.seed(args.seed)
+        sampler = iter(dataset.EpisodicBatchSampler(test_dataset.video_labels, args.way, args.shot+QUERY_NUM))
+        test_splits = EpisodeSplitSchedule(args.way, args.shot, QUERY_NUM, args.test_ep, args.seed)
+
+    accuracies = {variant: [] for variant in variants}
+    agreements = {variant: [] for variant in variants}
+    differences = {variant: 0.0 for variant in variants}
+    for ep in range(args.test_ep):
+        if args.dataset is not None:
+            episode = next(sampler)
+            data = torch.stack([test_dataset[idx][0] for idx in episode])    # [class*(support+query), window*clip, RGB, frame, H, W]
+            data_labels = dataset.episode_labels(torch.tensor([test_dataset.video_labels[idx] for idx in episode]))
+            support_index, query_index = stack_splits([test_splits[ep]], args.way*(args.shot+QUERY_NUM))
+        else:
+            data, data_labels, support_index, query_index = random_episodes(1, config, generator)
+        batches_labels = data_labels[query_index].numpy()
+
+        predictions = {}
+        for variant in variants:
+            precision, channels_last = VARIANTS[variant]
+            predictions[variant] = predict(pipelines[channels_last], precision, device, data, support_index, query_index)
+            accuracies[variant].append(np.mean(predictions[variant][0] == batches_labels))
+            agreements[variant].append(np.mean(predictions[variant][0] == predictions["fp32"][0]))
+            differences[variant] = max(differences[variant], (predictions[variant][1] - predictions["fp32"][1]).abs().max().item())
+
+    for variant in variants[1:]:
+        if args.dataset is not None:
+            print("{} Accu = {:.4f}, fp32 Accu = {:.4f}, Delta = {:+.4f}".format(variant, np.mean(accuracies[variant]), np.mean(accuracies["fp32"]),
+                                                                              np.mean(accuracies[variant]) - np.mean(accuracies["fp32"])), end=", ")
+        print("{} agreement with fp32 = {:.4f}, max probability difference = {:.4f} over {} episodes".format(variant, np.mean(agreements[variant]), differences[variant], args.test_ep))
@@ -0,0 +1,90 @@
+import torch
+
+NEG_INF = -float("inf")
+
+
+def pad_targets(targets, target_lengths):
+    "split concatenated targets into a padded [S, L] tensor, padding with blank (0)"
+    target_lengths = torch.as_tensor(target_lengths, dtype=torch.long)
+    targets = torch.as_tensor(targets, dtype=torch.long)
+    S = int(target_lengths.shape[0])
+    L = max(int(target_lengths.max()), 1) if S > 0 else 1
+    padded = targets.new_zeros((S, L))
+    mask = torch.arange(L).unsqueeze(0) < target_lengths.unsqueeze(1)
+    padded[mask] = targets[:int(target_lengths.sum())]
+    return padded, target_lengths
+
+
+def ctc_log_likelihood(log_probs, targets, target_lengths, blank=0):
+    """
+    log p(target|input) of every input against every target with the CTC forward algorithm in log space.
+    log_probs: [N, T, C] log probabilities per time step, blank at index <blank>
+    targets: [S, L] labels padded to the longest target, target_lengths: [S]
+    Returns [N, S], all pairs are computed at once so that only T small tensor ops are issued.
+    """
+    N, T = int(log_probs.shape[0]), int(log_probs.shape[1])
+    device = log_probs.device
+    targets = torch.as_tensor(targets, dtype=torch.long, device=device)
+    target_lengths = torch.as_tensor(target_lengths, dtype=torch.long, device=device)
+    S, L = int(targets.shape[0]), int(targets.shape[1])
+
+    if S > 0 and bool((target_lengths == 1).all()):
+        return ctc_single_label_log_likelihood(log_probs, targets[:, 0], blank)
+
+    # Targets extended by blanks at the beginning, end and in between each label: [S, 2L+1]
+    extended = targets.new_full((S, 2*L+1), blank)
+    extended[:, 1::2] = targets
+
+    # A label may be reached from two states back unless it is a blank or a repeat of that label
+    skip = extended.new_zeros((S, 2*L+1), dtype=torch.bool)
+    skip[:, 2:] = (extended[:, 2:] != blank) & (extended[:, 2:] != extended[:, :-2])
+
+    emissions = log_probs[:, :, extended]                  # [N, T, S, 2L+1]
+
+    alpha = log_probs.new_full((N, S, 2*L+1), NEG_INF)
+    alpha[:, :, 0] = emissions[:, 0, :, 0]
+    alpha[:, :, 1] = torch.where(target_lengths > 0, emissions[:, 0, :, 1], alpha.new_full((1, ), NEG_INF))
+
+    neg_inf = log_probs.new_full((N, S, 1), NEG_INF)
+    for t in range(1, T):
+        stay = alpha
+        step = torch.cat((neg_inf, alpha[:, :, :-1]), 2)
+        jump = torch.cat((neg_inf, neg_inf, alpha[:, :, :-2]), 2).masked_fill(~skip, NEG_INF)
+        alpha = torch.logsumexp(torch.stack((stay, step, jump)), 0) + emissions[:, t]
+
+    # Paths end on the last label or on the blank after it
+    last = (2 * target_lengths).view(1, S, 1).expand(N, S, 1)
+    end_blank = alpha.gather(2, last).squeeze(2)
+    end_label = alpha.gather(2, (last - 1).clamp(min=0)).squeeze(2)
+    end_label = end_label.masked_fill((target_lengths == 0).view(1, S), NEG_INF)
+    return torch.logaddexp(end_blank, end_label)
+
+
+def ctc_single_label_log_likelihood(log_probs, labels, blank=0):
+    """
+    Closed form of ctc_log_likelihood when every target is a single label.
+    Such a path is blanks, then the label over one segment [i, j] of the input, then blanks again,
+    so p(label|input) is a sum over the T*(T+1)/2 segments, computed for all pairs in one expression.
+    log_probs: [N, T, C] log probabilities per time step, labels: [S], returns [N, S]
+    """
+    T = int(log_probs.shape[1])
+    dtype, device = log_probs.dtype, log_probs.device
+    labels = torch.as_tensor(labels, dtype=torch.long, device=device)
+
+    # Zero probabilities are kept finite so that they can be masked out by multiplication
+    log_probs = log_probs.clamp(min=torch.finfo(dtype).min / (T+1))
+
+    t = torch.arange(T, device=device)
+    inside = (t.view(T, 1, 1) <= t.view(1, 1, T)) & (t.view(1, 1, T) <= t.view(1, T, 1))   # [i, j, t]
+    inside = inside.to(dtype)
+    segments = t.view(T, 1) <= t.view(1, T)                                                 # [i, j]
+
+    label_sum = torch.einsum("ijt,nts->nsij", inside, log_probs[:, :, labels])               # [N, S, i, j]
+    blank_sum = torch.einsum("ijt,nt->nij", 1 - inside, log_probs[:, :, blank]).unsqueeze(1) # [N, 1, i, j]
+    scores = (label_sum + blank_sum).masked_fill(~segments, NEG_INF)
+    return torch.logsumexp(scores.flatten(2), 2)
+
+
+def ctc_likelihood(probs, targets, target_lengths, blank=0):
+    "p(target|input) of every input against every target, probs: [N, T, C] probabilities, returns [N, S]"
+    return ctc_log_likelihood(torch.log(probs), targets, target_lengths, blank).exp()
@@ -94,6 +94,120 @@ def decode(probs, beam_size=100, blank=0):
   best = beam[0]
   return best[0], -logsumexp(*best[1])
 
+def decode_greedy(probs, blank=0):
+  """
+  Best path decoding of a batch, the most likely label of every time
+  step with repeats merged and blanks removed.
+  Arguments:
+      probs: The output probabilities, an array of shape
+        (batch x time x output dim).
+      blank (int): Index of the CTC blank label.
+  Returns a list with the label sequence and the negative log-likelihood
+  of its best path for each item of the batch.
+  """
+  N, T, S = probs.shape
+  best = np.argmax(probs, axis=2)
+  scores = -np.sum(np.log(np.take_along_axis(probs, best[:, :, None], 2)[:, :, 0]), axis=1)
+
+  keep = best != blank
+  keep[:, 1:] &= best[:, 1:] != best[:, :-1]
+  return [(tuple(int(s) for s in best[n][keep[n]]), float(scores[n])) for n in range(N)]
+
+def decode_batch(probs, beam_size=100, blank=0):
+  """
+  Prefix beam search over a batch, equivalent to calling decode on every
+  item but with the beams of all items kept in arrays and updated together.
+  Arguments:
+      probs: The output probabilities (e.g. post-softmax), an array of
+        shape (batch x time x output dim).
+      beam_size (int): Size of the beam to use during inference, a beam of
+        one falls back to best path decoding.
+      blank (int): Index of the CTC blank label.
+  Returns a list with the output label sequence and the corresponding
+  negative log-likelihood for each item of the batch.
+  """
+  if beam_size == 1:
+    return decode_greedy(probs, blank)
+
+  N, T, S = probs.shape
+  with np.errstate(divide="ignore"):
+    probs = np.log(probs)
+  labels = np.array([s for s in range(S) if s != blank])
+
+  # A beam is a set of prefixes padded with -1 to length T, their lengths,
+  # and the log probabilities of ending in blank and in non-blank.
+  prefixes = np.full((N, 1, T), -1, dtype=np.int64)
+  lengths = np.zeros((N, 1), dtype=np.int64)
+  p_b = np.zeros((N, 1))
+  p_nb = np.full((N, 1), NEG_INF)
+
+  for t in range(T): # Loop over time
+    B = prefixes.shape[1]
+    p = probs[:, t]                                              # (N x S)
+    last = np.take_along_axis(prefixes, np.maximum(lengths - 1, 0)[:, :, None], 2)[:, :, 0]
+    last = np.where(lengths > 0, last, -1)                       # (N x B)
+
+    # Candidates keeping the prefix: a blank, or a repeat of the last label
+    p_last = np.where(last >= 0, np.take_along_axis(p, np.maximum(last, 0), 1), NEG_INF)
+    same_b = np.logaddexp(p_b, p_nb) + p[:, blank, None]
+    same_nb = p_nb + p_last
+
+    # Candidates extending the prefix by every non-blank label
+    p_s = p[:, None, labels]                                     # (N x 1 x S-1)
+    repeat = labels[None, None, :] == last[:, :, None]           # (N x B x S-1)
+    ext_nb = np.where(repeat, p_b[:, :, None], np.logaddexp(p_b, p_nb)[:, :, None]) + p_s
+    ext_prefixes = np.repeat(prefixes[:, :, None, :], len(labels), 2)
+    np.put_along_axis(ext_prefixes, np.minimum(lengths, T - 1)[:, :, None, None].repeat(len(labels), 2), labels[None, None, :, None], 3)
+
+    cand_prefixes = np.concatenate((prefixes, ext_prefixes.reshape(N, -1, T)), 1)
+    cand_lengths = np.concatenate((lengths, np.repeat(lengths + 1, len(labels), 1)), 1)
+    cand_b = np.concatenate((same_b, np.full((N, B*len(labels)), NEG_INF)), 1)
+    cand_nb = np.concatenate((same_nb, ext_nb.reshape(N, -1)), 1)
+    K = cand_prefixes.shape[1]
+
+    # Merge identical prefixes of an item, sorting the rows groups them
+    rows = np.concatenate((np.repeat(np.arange(N), K)[:, None], cand_prefixes.reshape(N*K, T)), 1)
+    order = np.lexsort(rows.T[::-1])
+    rows = rows[order]
+    first = np.ones(N*K, dtype=bool)
+    first[1:] = np.any(rows[1:] != rows[:-1], axis=1)
+    group = np.cumsum(first) - 1
+    G = int(group[-1]) + 1
+
+    merged_b = np.full(G, NEG_INF)
+    merged_nb = np.full(G, NEG_INF)
+    np.logaddexp.at(merged_b, group, cand_b.reshape(-1)[order])
+    np.logaddexp.at(merged_nb, group, cand_nb.reshape(-1)[order])
+    merged_prefixes = rows[first, 1:]
+    merged_lengths = cand_lengths.reshape(-1)[order][first]
+
+    # Scatter the groups back to (N x max groups) and keep the top beam_size
+    owner = rows[first, 0]
+    counts = np.bincount(owner, minlength=N)
+    slot = np.arange(G) - np.repeat(np.cumsum(counts) - counts, counts)
+    width = int(counts.max())
+    scores = np.full((N, width), NEG_INF)
+    scores[owner, slot] = np.logaddexp(merged_b, merged_nb)
+    dense = np.full((N, width), -1, dtype=np.int64)
+    dense[owner, slot] = np.arange(G)
+
+    if width > beam_size:
+      top = np.argpartition(-scores, beam_size - 1, axis=1)[:, :beam_size]
+    else:
+      top = np.broadcast_to(np.arange(width), (N, width))
+    keep = np.take_along_axis(dense, top, 1)                     # (N x beam)
+    valid = keep >= 0
+    keep = np.maximum(keep, 0)
+
+    prefixes = np.where(valid[:, :, None], merged_prefixes[keep], -1)
+    lengths = np.where(valid, merged_lengths[keep], 0)
+    p_b = np.where(valid, merged_b[keep], NEG_INF)
+    p_nb = np.where(valid, merged_nb[keep], NEG_INF)
+
+  scores = np.logaddexp(p_b, p_nb)
+  best = np.argmax(scores, axis=1)
+  return [(tuple(int(s) for s in prefixes[n, best[n], :lengths[n, best[n]]]), -float(scores[n, best[n]])) for n in range(N)]
+
 
   # np.random.seed()
 
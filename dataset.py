@@ -3,6 +3,7 @@ import torch                                         #
 import torchvision                                   #  Torch
 from torch.utils.data import DataLoader,Dataset      #
 from torch.utils.data.sampler import Sampler         #
+from torch.utils.data.dataloader import default_collate
 
 from vidaug import augmentors as va                  # Video Augmentation
 
@@ -11,8 +12,12 @@ import numpy as np                                   #  Image
 from scipy.ndimage import rotate as rotate_img       #
 
 import random                                        #  OS
+import math                                          #
 import os                                            #
 
+# Private Packages
+from frame_store import count_frames
+
 WIDTH = HEIGHT = 128
 # Augmentations
 prob_50 = lambda aug: va.Sometimes(0.5, aug) # Used to apply augmentor with 50% probability
@@ -37,6 +42,58 @@ def use_aug_seq(frames):
     
     return frames
 
+def list_frames(video_folder, frame_store=None, video_index=None):
+    # Packed videos need no listing, their frames are addressed by position in the store
+    if frame_store is not None and video_folder in frame_store:
+        return None, frame_store.length(video_folder)
+
+    if video_index is not None and video_folder in video_index:
+        all_frames = [os.path.join(video_folder, frame_name) for frame_name in video_index.frame_names(video_folder)]
+    else:
+        all_frames = [os.path.join(video_folder, frame_name) for frame_name in os.listdir(video_folder)]
+        all_frames.sort()
+    return all_frames, len(all_frames)
+
+def select_frames(length, frame_num, clip_num, window_num):
+    # Index of every frame of every clip, clipped to the last frame of the video # [window*clip, frame_num]
+    stride = round((length - frame_num)/(clip_num*window_num-1))
+    selected_frames = np.arange(clip_num*window_num)[:, None] * stride + np.arange(frame_num)[None, :]
+    return np.minimum(selected_frames, length - 1)
+
+def load_frames(video_folder, all_frames, frame_indices, frame_store=None, frame_size=WIDTH):
+    # Returns the requested frames as uint8 # [len(frame_indices), H, W, RGB]
+    if all_frames is None:
+        processed_frames = frame_store.read(video_folder, frame_indices)
+        if processed_frames.shape[1:3] == (frame_size, frame_size):
+            return processed_frames
+        # The store was packed at another size
+        return np.stack([cv2.resize(img, (frame_size, frame_size)) for img in processed_frames])
+
+    processed_frames = np.empty((len(frame_indices), frame_size, frame_size, 3), dtype=np.uint8)
+    for i, idx in enumerate(frame_indices):
+        img = cv2.imread(all_frames[idx])
+        img = cv2.resize(img, (frame_size, frame_size))   
+        processed_frames[i] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return processed_frames
+
+def load_clips(video_folder, all_frames, selected_frames, frame_store=None, augment=False, frame_size=WIDTH):
+    # Decode every distinct frame once, then gather all clips with a single indexing # [window*clip, frame_num, H, W, RGB]
+    unique_frames, inverse = np.unique(selected_frames, return_inverse=True)
+    processed_frames = load_frames(video_folder, all_frames, unique_frames, frame_store, frame_size)
+    if augment:
+        processed_frames = np.stack(use_aug_seq(list(processed_frames)))
+    return processed_frames[inverse.reshape(selected_frames.shape)]
+
+def to_clip_tensor(frames, normalize=True):
+    # uint8 [window*clip, frame_num, H, W, RGB] -> float32 [window*clip, RGB, frame_num, H, W] in -1 to 1
+    # Without normalize the clips stay uint8, see utils.normalize_clips
+    frames = torch.from_numpy(frames).permute(0, 4, 1, 2, 3)
+    if not normalize:
+        return frames.contiguous()
+    clips = torch.empty(frames.shape, dtype=torch.float32)
+    clips.copy_(frames)
+    return clips.div_(127.5).sub_(1)
+
 # class HAADataset(Dataset):
 #     def __init__(self, data_folders, mode, splits, class_num, video_num, inst_num, frame_num, clip_num, window_num):
 #         self.mode = mode
@@ -138,7 +195,7 @@ def use_aug_seq(frames):
 #         return frames, video_label
 
 class StandardDataset(Dataset):
-    def __init__(self, data_folders, mode, splits, class_num, inst_num, frame_num, clip_num, window_num):
+    def __init__(self, data_folders, mode, splits, class_num, inst_num, frame_num, clip_num, window_num, frame_store=None, video_index=None, normalize=True, frame_size=WIDTH):
         self.mode = mode
         assert mode in ["train", "val", "test"]
 
@@ -149,6 +206,10 @@ class StandardDataset(Dataset):
         self.clip_num = clip_num
         self.window_num = window_num
         self.data_folders = data_folders
+        self.frame_store = frame_store
+        self.video_index = video_index
+        self.normalize = normalize
+        self.frame_size = frame_size
 
         # Mode & Split
         if self.mode == "train":
@@ -170,16 +231,19 @@ class StandardDataset(Dataset):
             video_folders = []
             label = self.labels[class_name]
 
-            for data_folder in self.data_folders:
-                class_folder = os.path.join(data_folder, class_name)
-                if not os.path.exists(class_folder):
-                    continue
-                video_names = os.listdir(class_folder) if os.path.exists(class_folder) else []
+            if self.video_index is not None:
+                video_folders = self.video_index.videos(class_name, self.frame_num)
+            else:
+                for data_folder in self.data_folders:
+                    class_folder = os.path.join(data_folder, class_name)
+                    if not os.path.exists(class_folder):
+                        continue
+                    video_names = os.listdir(class_folder) if os.path.exists(class_folder) else []
 
-                for video_name in video_names:
-                    video_path = os.path.join(class_folder, video_name)
-                    if len(os.listdir(video_path)) >= self.frame_num:
-                        video_folders.append(video_path)
+                    for video_name in video_names:
+                        video_path = os.path.join(class_folder, video_name)
+                        if count_frames(video_path, self.frame_store) >= self.frame_num:
+                            video_folders.append(video_path)
 
             # Pick <self.inst_num> random videos
             video_folders = random.sample(video_folders, inst_num)
@@ -212,49 +276,12 @@ class StandardDataset(Dataset):
         video_label = self.video_labels[idx]
         # scale = self.scales[idx]
 
-        all_frames = [os.path.join(video_folder, frame_name) for frame_name in os.listdir(video_folder)]
-        all_frames.sort()
-        # all_frames = all_frames[::scale]
+        all_frames, length = list_frames(video_folder, self.frame_store, self.video_index)
+        selected_frames = select_frames(length, self.frame_num, self.clip_num, self.window_num)  # [window*clip, frame_num]
 
-        
-        length = len(all_frames)
-        stride = round((length - self.frame_num)/(self.clip_num*self.window_num-1))
-        
-        selected_frames = []
-        for i in range(self.clip_num*self.window_num):
-            selected_frames.extend(list(range(i*stride, i*stride+self.frame_num)))
-        for i in range(len(selected_frames)):
-            if selected_frames[i] >= length:
-                selected_frames[i] = length - 1
-        
         # Process frames
-        processed_frames = [None] * length
-        for idx in selected_frames:
-            if processed_frames[idx] is None:
-                frame = all_frames[idx]
-                img = cv2.imread(frame)
-                img = cv2.resize(img, (WIDTH, HEIGHT))   
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                # # Rotate
-                # if self.mode == "train" and random.randint(0,1):
-                #     angle = random.randint(-25,25)
-                #     img = rotate_img(img, angle, reshape=False)
-                processed_frames[idx] = img
-        if self.mode == 'train':
-            processed_frames = use_aug_seq(processed_frames)
-
-        frames = []
-        for i, frame_idx in enumerate(selected_frames):
-            j = i % self.frame_num
-            if j == 0:
-                frames.append([])
-            
-            frame = processed_frames[frame_idx].copy()
-            frames[-1].append(frame)
-        
-        frames = np.array(frames) / 127.5 - 1              # -1 to 1 # [num_frame, h, w, channel]
-        frames = np.transpose(frames, (0, 4, 1, 2, 3))     # [window*clip, RGB, frame_num, H, W]
-        frames = torch.Tensor(frames.copy())
+        frames = load_clips(video_folder, all_frames, selected_frames, self.frame_store, augment=(self.mode == 'train'), frame_size=self.frame_size)
+        frames = to_clip_tensor(frames, self.normalize)    # [window*clip, RGB, frame_num, H, W]
 
         return frames, video_label
 
@@ -353,12 +380,12 @@ class AVADataset(Dataset):
 
         noise = random.randint(0,1)
         if self.mode == "train" and noise:
-            frames = frames + 0.1 * torch.randn(self.window_num*self.clip_num, 3, self.frame_num, 128, 128)
+            frames = frames + 0.1 * torch.randn(frames.shape)
 
         return frames, video_label, video_folder
 
 class FinegymDataset(Dataset):
-    def __init__(self, data_folder, info_dict, mode, splits, class_num, inst_num, frame_num, clip_num, window_num):
+    def __init__(self, data_folder, info_dict, mode, splits, class_num, inst_num, frame_num, clip_num, window_num, frame_store=None, video_index=None, normalize=True, frame_size=WIDTH):
         self.mode = mode
         assert mode in ['train', 'val', 'test']
         
@@ -369,6 +396,10 @@ class FinegymDataset(Dataset):
         self.clip_num = clip_num
         self.window_num = window_num
         self.data_folder = data_folder
+        self.frame_store = frame_store
+        self.video_index = video_index
+        self.normalize = normalize
+        self.frame_size = frame_size
 
         # Mode & Split
         if self.mode == "train":
@@ -394,12 +425,15 @@ class FinegymDataset(Dataset):
         self.video_labels = []
         for class_name in self.class_names:
             label = self.labels[class_name]
-            video_folders = info_dict[class_name]
-            video_folders = [os.path.join(data_folder, vid) for vid in video_folders]
-            sample_folders = []
-            for video_folder in video_folders:
-                if os.path.exists(video_folder) and len(os.listdir(video_folder)) >= frame_num:
-                    sample_folders.append(video_folder)
+            if self.video_index is not None:
+                sample_folders = self.video_index.videos(class_name, frame_num)
+            else:
+                video_folders = info_dict[class_name]
+                video_folders = [os.path.join(data_folder, vid) for vid in video_folders]
+                sample_folders = []
+                for video_folder in video_folders:
+                    if os.path.exists(video_folder) and count_frames(video_folder, self.frame_store) >= frame_num:
+                        sample_folders.append(video_folder)
             sample_folders = random.sample(sample_folders, inst_num)
 
             self.video_folders.extend(sample_folders)
@@ -412,47 +446,12 @@ class FinegymDataset(Dataset):
         video_folder = self.video_folders[idx]
         video_label = self.video_labels[idx]
 
-        all_frames = [os.path.join(video_folder, frame_name) for frame_name in os.listdir(video_folder)]
-        all_frames.sort()
+        all_frames, length = list_frames(video_folder, self.frame_store, self.video_index)
+        selected_frames = select_frames(length, self.frame_num, self.clip_num, self.window_num)  # [window*clip, frame_num]
 
-        length = len(all_frames)
-        stride = round((length - self.frame_num)/(self.clip_num*self.window_num-1))
-        
-        selected_frames = []
-        for i in range(self.clip_num*self.window_num):
-            selected_frames.extend(list(range(i*stride, i*stride+self.frame_num)))
-        for i in range(len(selected_frames)):
-            if selected_frames[i] >= length:
-                selected_frames[i] = length - 1
-        
         # Process frames
-        processed_frames = [None] * length
-        for idx in selected_frames:
-            if processed_frames[idx] is None:
-                frame = all_frames[idx]
-                img = cv2.imread(frame)
-                img = cv2.resize(img, (WIDTH, HEIGHT))   
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                # # Rotate
-                # if self.mode == "train" and random.randint(0,1):
-                #     angle = random.randint(-25,25)
-                #     img = rotate_img(img, angle, reshape=False)
-                processed_frames[idx] = img
-        if self.mode == 'train':
-            processed_frames = use_aug_seq(processed_frames)
-
-        frames = []
-        for i, frame_idx in enumerate(selected_frames):
-            j = i % self.frame_num
-            if j == 0:
-                frames.append([])
-            
-            frame = processed_frames[frame_idx].copy()
-            frames[-1].append(frame)
-        
-        frames = np.array(frames) / 127.5 - 1              # -1 to 1 # [num_frame, h, w, channel]
-        frames = np.transpose(frames, (0, 4, 1, 2, 3))     # [window*clip, RGB, frame_num, H, W]
-        frames = torch.Tensor(frames.copy())
+        frames = load_clips(video_folder, all_frames, selected_frames, self.frame_store, augment=(self.mode == 'train'), frame_size=self.frame_size)
+        frames = to_clip_tensor(frames, self.normalize)    # [window*clip, RGB, frame_num, H, W]
 
         return frames, video_label       
 
@@ -609,4 +608,103 @@ class ClassBalancedSampler(Sampler):
 def get_data_loader(dataset, num_per_class, shuffle=False, num_workers=0):
     sampler = ClassBalancedSampler(num_per_class, dataset.class_num, dataset.inst_num, shuffle)
     loader = DataLoader(dataset, batch_size=num_per_class*dataset.class_num, sampler=sampler, num_workers=num_workers)
-    return loader
\ No newline at end of file
+    return loader
+
+class VideoDataset(Dataset):
+    def __init__(self, video_folders, video_labels, mode, frame_num, clip_num, window_num, frame_store=None, video_index=None, normalize=True, frame_size=WIDTH):
+        self.mode = mode
+        assert mode in ["train", "val", "test"]
+
+        # Attribute
+        self.video_folders = video_folders
+        self.video_labels = video_labels
+        self.frame_num = frame_num
+        self.clip_num = clip_num
+        self.window_num = window_num
+        self.frame_store = frame_store
+        self.video_index = video_index
+        self.normalize = normalize
+        self.frame_size = frame_size
+        self.augment = (mode == 'train')
+
+    def __len__(self):
+        return len(self.video_folders)
+
+    def __getitem__(self, idx):
+        video_folder = self.video_folders[idx]
+        video_label = self.video_labels[idx]
+
+        all_frames, length = list_frames(video_folder, self.frame_store, self.video_index)
+        selected_frames = select_frames(length, self.frame_num, self.clip_num, self.window_num)  # [window*clip, frame_num]
+
+        # Process frames
+        frames = load_clips(video_folder, all_frames, selected_frames, self.frame_store, augment=self.augment, frame_size=self.frame_size)
+        frames = to_clip_tensor(frames, self.normalize)    # [window*clip, RGB, frame_num, H, W]
+
+        return frames, video_label
+
+def get_video_dataset(dataset_info, mode, video_index, frame_num, clip_num, window_num, min_video_num=1, frame_store=None, normalize=True, frame_size=WIDTH):
+    # One dataset with every usable video of the split, labels are class indices in the split
+    class_names = dataset_info["splits"][["train", "val", "test"].index(mode)]
+
+    video_folders = []
+    video_labels = []
+    label = 0
+    for class_name in class_names:
+        class_folders = video_index.videos(class_name, frame_num)
+        if len(class_folders) < min_video_num:
+            continue
+        video_folders.extend(class_folders)
+        video_labels.extend([label] * len(class_folders))
+        label += 1
+
+    return VideoDataset(video_folders, video_labels, mode, frame_num, clip_num, window_num, frame_store, video_index, normalize, frame_size)
+
+class EpisodicBatchSampler(Sampler):
+
+    def __init__(self, video_labels, class_num, num_per_class, seed=None):
+        self.class_num = class_num
+        self.num_per_class = num_per_class
+        # Episodes of a seeded sampler do not depend on any other use of the random module
+        self.random = random.Random(seed) if seed is not None else random
+
+        self.class_indices = dict()
+        for idx, label in enumerate(video_labels):
+            self.class_indices.setdefault(label, []).append(idx)
+        self.labels = [label for label, indices in self.class_indices.items() if len(indices) >= num_per_class]
+        if len(self.labels) < class_num:
+            raise Exception("only {} classes have {} videos, {} are needed".format(len(self.labels), num_per_class, class_num))
+
+    def __iter__(self):
+        # Endless stream of episodes, each a list of indices grouped by class
+        while True:
+            batch = []
+            for label in self.random.sample(self.labels, self.class_num):
+                batch.extend(self.random.sample(self.class_indices[label], self.num_per_class))
+            yield batch
+
+def episode_labels(video_labels):
+    # Items arrive grouped by class, relabel the classes of the episode as 1...class_num
+    _, data_labels = torch.unique_consecutive(video_labels, return_inverse=True)
+    return data_labels + 1
+
+def episode_collate(batch):
+    data, video_labels = default_collate(batch)
+    return data, episode_labels(video_labels)
+
+def get_episode_loader(video_dataset, class_num, num_per_class, num_workers=4, prefetch=8, episodes=None, seed=None):
+    # Random episodes: workers stay alive between episodes and keep at most <prefetch> episodes ready in pinned memory
+    # Fixed <episodes>: loaded once in order, the workers and their buffers are released when the last one is read,
+    # so that e.g. a validation loader holds no memory between its passes
+    if episodes is None:
+        sampler = EpisodicBatchSampler(video_dataset.video_labels, class_num, num_per_class, seed)
+    else:
+        sampler = episodes
+    pin_memory = torch.cuda.is_available()
+    if num_workers == 0:
+        return DataLoader(video_dataset, batch_sampler=sampler, collate_fn=episode_collate, pin_memory=pin_memory)
+
+    prefetch_factor = max(1, int(math.ceil(prefetch / num_workers)))
+    loader = DataLoader(video_dataset, batch_sampler=sampler, collate_fn=episode_collate, num_workers=num_workers,
+                        prefetch_factor=prefetch_factor, pin_memory=pin_memory, persistent_workers=episodes is None)
+    return loader
@@ -0,0 +1,138 @@
+# Public Packages
+import torch                                         #  Torch
+from torch.utils.data import DataLoader, Subset      #
+
+import collections                                   #
+import copy                                          #
+import hashlib                                       #
+import json                                          #  OS
+import os                                            #
+
+# An embedding cache maps (video folder, checkpoint hash, sampling params) to the TCN output of the video,
+# [window*clip, feature]. Test videos are sampled without augmentation and the encoder is frozen,
+# so the embedding of a video never changes for a given checkpoint and parameters.
+# The memory tier keeps the most recently used <capacity> embeddings, the optional disk tier keeps all of them
+# as <cache_dir>/<key[:2]>/<key>.pt so that later runs on the same checkpoint can reuse them.
+
+def file_hash(paths, chunk_size=1024**2):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def checkpoint_hash(checkpoint_dir, names=("c3d.pkl", "tcn.pkl")):
+    # Only the encoder weights decide the embeddings
+    return file_hash([os.path.join(checkpoint_dir, name) for name in names])
+
+class EmbeddingCache(object):
+
+    def __init__(self, checkpoint, params, capacity=100000, cache_dir=None):
+        self.prefix = json.dumps([checkpoint, params], sort_keys=True)
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __contains__(self, video_folder):
+        key = self.key(video_folder)
+        return key in self.memory or (self.cache_dir is not None and os.path.exists(self.path(key)))
+
+    def key(self, video_folder):
+        return hashlib.sha1((self.prefix + os.path.normpath(video_folder)).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".pt")
+
+    def remember(self, key, embed):
+        self.memory[key] = embed
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get(self, video_folder):
+        key = self.key(video_folder)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            embed = torch.load(self.path(key))
+            self.remember(key, embed)
+            self.hits += 1
+            return embed
+
+        self.misses += 1
+        return None
+
+    def put(self, video_folder, embed):
+        key = self.key(video_folder)
+        embed = embed.detach().cpu()
+        self.remember(key, embed)
+
+        if self.cache_dir is not None and not os.path.exists(self.path(key)):
+            os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+            # Written aside and renamed, so that an interrupted run never leaves a partial file
+            tmp_path = self.path(key) + ".tmp"
+            torch.save(embed, tmp_path)
+            os.replace(tmp_path, self.path(key))
+
+def fill_cache(cache, video_dataset, indices, encode, batch_size, num_workers=4):
+    # Encode the videos of <indices> missing from the cache, decoded by <num_workers> processes
+    missing = sorted(set(idx for idx in indices if video_dataset.video_folders[idx] not in cache))
+    if len(missing) == 0:
+        return 0
+
+    loader = DataLoader(Subset(video_dataset, missing), batch_size=batch_size, num_workers=num_workers, pin_memory=torch.cuda.is_available())
+    start = 0
+    for data, _ in loader:
+        embed = encode(data)                       # [batch, window*clip, feature]
+        for i in range(len(embed)):
+            cache.put(video_dataset.video_folders[missing[start + i]], embed[i])
+        start += len(embed)
+
+    return len(missing)
+
+def cached_embeddings(cache, video_dataset, indices, encode):
+    # Embeddings of the videos of one episode, videos evicted in between are encoded again # [len(indices), window*clip, feature]
+    embeds = []
+    for idx in indices:
+        video_folder = video_dataset.video_folders[idx]
+        embed = cache.get(video_folder)
+        if embed is None:
+            data, _ = video_dataset[idx]
+            embed = encode(data.unsqueeze(0))[0]
+            cache.put(video_folder, embed)
+        embeds.append(embed)
+
+    return torch.stack(embeds)
+
+def extract_features(video_dataset, encode, batch_size, num_workers=4):
+    # Encode every video of the dataset once, without augmentation # [video, window*clip, feature]
+    video_dataset = copy.copy(video_dataset)
+    video_dataset.augment = False
+
+    loader = DataLoader(video_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=torch.cuda.is_available())
+    features = []
+    for n, (data, _) in enumerate(loader):
+        features.append(encode(data).detach().cpu())
+        print("Extracted[{}/{}]".format(n+1, len(loader)))
+    return torch.cat(features)
+
+def load_features(path, key, video_dataset, encode, batch_size, num_workers=4):
+    # Saved features are reused when they were extracted with the same key from the same videos
+    if path is not None and os.path.exists(path):
+        state = torch.load(path)
+        if state["key"] == key and state["video_folders"] == video_dataset.video_folders:
+            return state["features"]
+
+    features = extract_features(video_dataset, encode, batch_size, num_workers)
+    if path is not None:
+        torch.save({"key": key, "video_folders": video_dataset.video_folders, "features": features}, path)
+    return features
@@ -24,7 +24,26 @@ def weights_init(m):
         m.weight.data.normal_(0, 0.01)
         m.bias.data = torch.ones(m.bias.data.size())
 
+def split_pad(pads):
+    # 'same' paddings [t, h, w] -> front and back paddings [t, h, w], the extra one goes to the back
+    front = tuple(p // 2 for p in pads)
+    back = tuple(p - p // 2 for p in pads)
+    return front, back
+
+def pool_size(size, kernel, stride, padding, ceil_mode):
+    # Output length of a max pool, as computed by torch
+    out = (size + 2 * padding - kernel + (stride - 1 if ceil_mode else 0)) // stride + 1
+    if ceil_mode and (out - 1) * stride >= size + padding:
+        out -= 1
+    return out
+
 class MaxPool3dSamePadding(nn.MaxPool3d):
+
+    def __init__(self, *args, nonnegative=False, **kwargs):
+        # nonnegative: the input is known to be >= 0 (e.g. after a ReLU), so the zero padding can be done by the pool itself
+        super(MaxPool3dSamePadding, self).__init__(*args, **kwargs)
+        self.nonnegative = nonnegative
+        self._padding = dict()
     
     def compute_pad(self, dim, s):
         if s % self.stride[dim] == 0:
@@ -32,31 +51,31 @@ class MaxPool3dSamePadding(nn.MaxPool3d):
         else:
             return max(self.kernel_size[dim] - (s % self.stride[dim]), 0)
 
+    def static_padding(self, t, h, w):
+        # 'same' padding only depends on the input shape, so it is computed once per shape
+        # Returns (F.pad padding or None, padding of the pool, ceil_mode of the pool)
+        if (t, h, w) not in self._padding:
+            pads = [self.compute_pad(dim, s) for dim, s in enumerate((t, h, w))]
+            front, back = split_pad(pads)
+
+            # The pool pads with -inf instead of 0, which only gives the same maxima on nonnegative inputs.
+            # An extra back padding is covered by ceil_mode when it yields the same windows as the zero padding.
+            ceil_mode = front != back
+            same_windows = all(pool_size(s, self.kernel_size[dim], self.stride[dim], front[dim], ceil_mode) == -(-s // self.stride[dim])
+                               for dim, s in enumerate((t, h, w)))
+            if (self.nonnegative or max(pads) == 0) and same_windows:
+                self._padding[(t, h, w)] = (None, front, ceil_mode)
+            else:
+                self._padding[(t, h, w)] = ((front[2], back[2], front[1], back[1], front[0], back[0]), 0, False)
+        return self._padding[(t, h, w)]
+
     def forward(self, x):
-        # compute 'same' padding
+        # compute 'same' padding, F.pad and the pool keep the memory format of x
         (batch, channel, t, h, w) = x.size()
-        #print t,h,w
-        out_t = np.ceil(float(t) / float(self.stride[0]))
-        out_h = np.ceil(float(h) / float(self.stride[1]))
-        out_w = np.ceil(float(w) / float(self.stride[2]))
-        #print out_t, out_h, out_w
-        pad_t = self.compute_pad(0, t)
-        pad_h = self.compute_pad(1, h)
-        pad_w = self.compute_pad(2, w)
-        #print pad_t, pad_h, pad_w
-
-        pad_t_f = pad_t // 2
-        pad_t_b = pad_t - pad_t_f
-        pad_h_f = pad_h // 2
-        pad_h_b = pad_h - pad_h_f
-        pad_w_f = pad_w // 2
-        pad_w_b = pad_w - pad_w_f
-
-        pad = (pad_w_f, pad_w_b, pad_h_f, pad_h_b, pad_t_f, pad_t_b)
-        #print x.size()
-        #print pad
-        x = F.pad(x, pad)
-        return super(MaxPool3dSamePadding, self).forward(x)
+        pad, padding, ceil_mode = self.static_padding(t, h, w)
+        if pad is not None:
+            x = F.pad(x, pad)
+        return F.max_pool3d(x, self.kernel_size, self.stride, padding, self.dilation, ceil_mode)
     
 
 class Unit3D(nn.Module):
@@ -91,40 +110,34 @@ class Unit3D(nn.Module):
         if self._use_batch_norm:
             self.bn = nn.BatchNorm3d(self._output_channels, eps=0.001, momentum=0.01)
 
+        self._padding = dict()
+
     def compute_pad(self, dim, s):
         if s % self._stride[dim] == 0:
             return max(self._kernel_shape[dim] - self._stride[dim], 0)
         else:
             return max(self._kernel_shape[dim] - (s % self._stride[dim]), 0)
 
+    def static_padding(self, t, h, w):
+        # 'same' padding only depends on the input shape, so it is computed once per shape
+        # Returns (F.pad padding or None, padding of the conv), symmetric zero padding is done by the conv itself
+        if (t, h, w) not in self._padding:
+            front, back = split_pad([self.compute_pad(dim, s) for dim, s in enumerate((t, h, w))])
+            if front == back:
+                self._padding[(t, h, w)] = (None, front)
+            else:
+                self._padding[(t, h, w)] = ((front[2], back[2], front[1], back[1], front[0], back[0]), 0)
+        return self._padding[(t, h, w)]
             
     def forward(self, x):
         # compute 'same' padding
+        # F.pad, the conv, batch norm and activation keep the memory format of x, a channels_last_3d x stays channels_last_3d
         (batch, channel, t, h, w) = x.size()
-        #print t,h,w
-        out_t = np.ceil(float(t) / float(self._stride[0]))
-        out_h = np.ceil(float(h) / float(self._stride[1]))
-        out_w = np.ceil(float(w) / float(self._stride[2]))
-        #print out_t, out_h, out_w
-        pad_t = self.compute_pad(0, t)
-        pad_h = self.compute_pad(1, h)
-        pad_w = self.compute_pad(2, w)
-        #print pad_t, pad_h, pad_w
-
-        pad_t_f = pad_t // 2
-        pad_t_b = pad_t - pad_t_f
-        pad_h_f = pad_h // 2
-        pad_h_b = pad_h - pad_h_f
-        pad_w_f = pad_w // 2
-        pad_w_b = pad_w - pad_w_f
-
-        pad = (pad_w_f, pad_w_b, pad_h_f, pad_h_b, pad_t_f, pad_t_b)
-        #print x.size()
-        #print pad
-        x = F.pad(x, pad)
-        #print x.size()        
-
-        x = self.conv3d(x)
+        pad, padding = self.static_padding(t, h, w)
+        if pad is not None:
+            x = F.pad(x, pad)
+
+        x = F.conv3d(x, self.conv3d.weight, self.conv3d.bias, self.conv3d.stride, padding, self.conv3d.dilation, self.conv3d.groups)
         if self._use_batch_norm:
             x = self.bn(x)
         if self._activation_fn is not None:
@@ -142,7 +155,8 @@ class InceptionModule(nn.Module):
         self.b1b = Unit3D(in_channels=out_channels[1], output_channels=out_channels[2], kernel_shape=[3, 3, 3])
         self.b2a = Unit3D(in_channels=in_channels, output_channels=out_channels[3], kernel_shape=[1, 1, 1], padding=0)
         self.b2b = Unit3D(in_channels=out_channels[3], output_channels=out_channels[4], kernel_shape=[3, 3, 3])
-        self.b3a = MaxPool3dSamePadding(kernel_size=[3, 3, 3],stride=(1, 1, 1), padding=0)
+        # Inputs of an inception module are ReLU outputs or their max pool
+        self.b3a = MaxPool3dSamePadding(kernel_size=[3, 3, 3],stride=(1, 1, 1), padding=0, nonnegative=True)
         self.b3b = Unit3D(in_channels=in_channels, output_channels=out_channels[5], kernel_shape=[1, 1, 1], padding=0,)
 
     def forward(self, x):    
@@ -164,7 +178,7 @@ class InceptionI3d(nn.Module):
         self.l1 = Unit3D(in_channels=in_channels, output_channels=64, kernel_shape=[7, 7, 7], stride=(2, 2, 2), padding=(3,3,3))
         
         'MaxPool3d_2a_3x3'
-        self.l2 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0)
+        self.l2 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0, nonnegative=True)
         
         'Conv3d_2b_1x1'
         self.l3 = Unit3D(in_channels=64, output_channels=64, kernel_shape=[1, 1, 1], padding=0)
@@ -173,7 +187,7 @@ class InceptionI3d(nn.Module):
         self.l4 = Unit3D(in_channels=64, output_channels=192, kernel_shape=[3, 3, 3], padding=1)
 
         'MaxPool3d_3a_3x3'
-        self.l5 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0)
+        self.l5 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0, nonnegative=True)
         
         # 'Mixed_3b'
         self.l6 = InceptionModule(192, [64,96,128,16,32,32])
@@ -182,7 +196,7 @@ class InceptionI3d(nn.Module):
         self.l7 = InceptionModule(256, [128,128,192,32,96,64])
 
         # 'MaxPool3d_4a_3x3'
-        self.l8 = MaxPool3dSamePadding(kernel_size=[3, 3, 3], stride=(2, 2, 2), padding=0)
+        self.l8 = MaxPool3dSamePadding(kernel_size=[3, 3, 3], stride=(2, 2, 2), padding=0, nonnegative=True)
 
         # 'Mixed_4b'
         self.l9 = InceptionModule(128+192+96+64, [192,96,208,16,48,64])
@@ -200,7 +214,7 @@ class InceptionI3d(nn.Module):
         self.l13 = InceptionModule(112+288+64+64, [256,160,320,32,128,128])
 
         # 'MaxPool3d_5a_2x2'
-        self.l14 = MaxPool3dSamePadding(kernel_size=[2, 2, 2], stride=(2, 2, 2), padding=0)
+        self.l14 = MaxPool3dSamePadding(kernel_size=[2, 2, 2], stride=(2, 2, 2), padding=0, nonnegative=True)
 
         # # 'Mixed_5b'
         # self.l15 = InceptionModule(256+320+128+128, [256,160,320,32,128,128])
@@ -231,26 +245,69 @@ class InceptionI3d(nn.Module):
         return x
 
 
+class SpatialAvgPool3d(nn.Module):
+    # Same as nn.AdaptiveAvgPool3d((None, 1, 1)) as a plain mean, which torch.onnx.export has an ONNX function for
+
+    def forward(self, x):
+        return x.mean((3, 4), keepdim=True)
+
+
+HEADS = ["flatten", "avg", "bottleneck"]
+
 class Simple3DEncoder(nn.Module):
 
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, head="flatten", frame_num=10, frame_size=128, head_channels=32, channels_last=False):
         super(Simple3DEncoder, self).__init__()
 
         self.l1 = Unit3D(in_channels=in_channels, output_channels=64, kernel_shape=[7, 7, 7], stride=(2, 2, 2), padding=(3,3,3))
-        self.l2 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0)
+        self.l2 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0, nonnegative=True)
         self.l3 = Unit3D(in_channels=64, output_channels=64, kernel_shape=[1, 1, 1], padding=0)
         self.l4 = Unit3D(in_channels=64, output_channels=192, kernel_shape=[3, 3, 3], padding=1)
-        self.l5 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0)
+        self.l5 = MaxPool3dSamePadding(kernel_size=[1, 3, 3], stride=(1, 2, 2), padding=0, nonnegative=True)
+
+        # Feature map after l5 is [192, frame/2, size/8, size/8] (rounded up by the same padding)
+        t = int(math.ceil(frame_num / 2))
+        s = int(math.ceil(math.ceil(math.ceil(frame_size / 2) / 2) / 2))
+
+        # Head between the feature map and the TCN, "flatten" keeps the original layout and checkpoints
+        if head not in HEADS:
+            raise Exception("unknown encoder head: {}".format(head))
+        self.head_type = head
+        if head == "flatten":
+            self.head = None
+            self.output_dim = 192 * t * s * s
+        elif head == "avg":
+            self.head = SpatialAvgPool3d()
+            self.output_dim = 192 * t
+        else:
+            # Learned 1x4x4 convolution with a 4x4 stride, every output pixel reduces one 4x4 patch of the 192 channels
+            self.head = Unit3D(in_channels=192, output_channels=head_channels, kernel_shape=[1, 4, 4], stride=(1, 4, 4), padding=0)
+            self.output_dim = head_channels * t * int(math.ceil(s / 4)) * int(math.ceil(s / 4))
 
         self.apply(weights_init)
+
+        # channels_last_3d (NDHWC) is the layout of the oneDNN 3-D convolutions on CPU. The weights are converted here
+        # and the clips once at the input, every layer then keeps the layout, so no layer reorders its input or output.
+        # Loaded state dicts are copied into the converted weights and keep their layout.
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last_3d)
     
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+
         x = self.l1(x)
         x = self.l2(x)
         x = self.l3(x)
         x = self.l4(x)
         x = self.l5(x)
+        if self.head is not None:
+            x = self.head(x)
 
+        if self.channels_last:
+            # Back to NCDHW, so that the features are flattened in the order of the TCN input
+            x = x.contiguous()
         return x
 
 
@@ -0,0 +1,142 @@
+# Public Packages
+import cv2                                           #  Image
+import numpy as np                                   #
+
+import argparse                                      #
+import json                                          #  OS
+import os                                            #
+
+WIDTH = HEIGHT = 128
+INDEX_NAME = "index.json"
+SHARD_NAME = "shard_{:04d}.bin"
+
+# Layout of a frame store folder:
+#   index.json      {"size": [H, W], "shards": [...], "videos": {video_folder: [shard, offset, length]}}
+#   shard_XXXX.bin  raw uint8 frames, [frame, H, W, RGB], already resized and converted to RGB
+# Offsets and lengths are counted in frames, so a video is the slice [offset, offset+length) of its shard.
+
+def video_key(video_folder):
+    return os.path.normpath(video_folder)
+
+def decode_frame(frame_path, width=WIDTH, height=HEIGHT):
+    img = cv2.imread(frame_path)
+    img = cv2.resize(img, (width, height))
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img
+
+def pack_videos(video_folders, store_dir, width=WIDTH, height=HEIGHT, shard_bytes=4*1024**3):
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    frame_bytes = width * height * 3
+    index = {"size": [height, width], "shards": [], "videos": dict()}
+
+    shard = None
+    shard_frames = 0
+    for n, video_folder in enumerate(video_folders):
+        frame_names = sorted(os.listdir(video_folder))
+        if len(frame_names) == 0:
+            continue
+
+        # Start a new shard when the current one would overflow
+        if shard is None or (shard_frames + len(frame_names)) * frame_bytes > shard_bytes:
+            if shard is not None:
+                shard.close()
+            index["shards"].append(SHARD_NAME.format(len(index["shards"])))
+            shard = open(os.path.join(store_dir, index["shards"][-1]), "wb")
+            shard_frames = 0
+
+        for frame_name in frame_names:
+            img = decode_frame(os.path.join(video_folder, frame_name), width, height)
+            shard.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+
+        index["videos"][video_key(video_folder)] = [len(index["shards"])-1, shard_frames, len(frame_names)]
+        shard_frames += len(frame_names)
+        print("Packed[{}/{}] {}".format(n+1, len(video_folders), video_folder))
+
+    if shard is not None:
+        shard.close()
+
+    with open(os.path.join(store_dir, INDEX_NAME), "w") as file:
+        file.write(json.dumps(index))
+
+    return index
+
+class FrameStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME), "r") as file:
+            index = json.loads(file.read())
+
+        self.height, self.width = index["size"]
+        self.shard_names = index["shards"]
+        self.videos = index["videos"]
+
+        # Shards are mapped lazily so that every DataLoader worker maps them on its own
+        self.shards = [None] * len(self.shard_names)
+
+    def __contains__(self, video_folder):
+        return video_key(video_folder) in self.videos
+
+    def __len__(self):
+        return len(self.videos)
+
+    def get_shard(self, i):
+        if self.shards[i] is None:
+            path = os.path.join(self.store_dir, self.shard_names[i])
+            self.shards[i] = np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, self.height, self.width, 3)
+        return self.shards[i]
+
+    def length(self, video_folder):
+        return self.videos[video_key(video_folder)][2]
+
+    def read(self, video_folder, indices):
+        # Returns uint8 frames [len(indices), H, W, RGB], only the requested frames are copied out of the map
+        shard, offset, length = self.videos[video_key(video_folder)]
+        indices = np.asarray(indices, dtype=np.int64)
+        return self.get_shard(shard)[offset + indices]
+
+    def __getstate__(self):
+        # Memory maps are not sent to workers, they are re-opened on first read
+        state = self.__dict__.copy()
+        state["shards"] = [None] * len(self.shard_names)
+        return state
+
+def count_frames(video_folder, frame_store=None):
+    # Length of a video, from the store if it is packed there, otherwise by listing its folder
+    if frame_store is not None and video_folder in frame_store:
+        return frame_store.length(video_folder)
+    return len(os.listdir(video_folder))
+
+def list_dataset_videos(dataset_info):
+    video_folders = []
+    if dataset_info["name"] != "finegym":
+        for data_folder in dataset_info["folders"]:
+            for class_name in sorted(os.listdir(data_folder)):
+                class_folder = os.path.join(data_folder, class_name)
+                if not os.path.isdir(class_folder):
+                    continue
+                for video_name in sorted(os.listdir(class_folder)):
+                    video_folders.append(os.path.join(class_folder, video_name))
+    else:
+        for class_name in sorted(dataset_info["finegym_info"].keys()):
+            for video_name in dataset_info["finegym_info"][class_name]:
+                video_folder = os.path.join(dataset_info["folder"], video_name)
+                if os.path.isdir(video_folder):
+                    video_folders.append(video_folder)
+
+    return video_folders
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", help="path of the dataset json file", required=True)
+    parser.add_argument("-o", "--output", help="folder to write the frame store into", required=True)
+    parser.add_argument("--shard_gb", help="maximum size of one shard file in GB", type=float, default=4)
+    parser.add_argument("--size", help="height and width of the packed frames", type=int, default=WIDTH)
+    args = parser.parse_args()
+
+    with open(args.dataset, "r") as file:
+        dataset_info = json.loads(file.readline())
+
+    pack_videos(list_dataset_videos(dataset_info), args.output, args.size, args.size, shard_bytes=int(args.shard_gb*1024**3))
@@ -0,0 +1,71 @@
+# Public Packages
+import torch                                         #  Torch
+import torch.nn as nn                                #
+from torch.nn.utils import parametrize               #
+
+import copy                                          #  OS
+import functools                                     #
+
+from encoder import Unit3D
+
+# Inference graph of a trained model. weight_norm is removed so that conv weights are plain tensors instead of
+# being rebuilt from weight_g/weight_v on every forward, and every BatchNorm, an affine map of its running
+# statistics in eval mode, is folded into the conv or linear layer in front of it.
+# Folded batch norms are replaced by nn.Identity, so the indices of nn.Sequential and the checkpoint keys of the
+# remaining layers are kept. The fused copy only reproduces eval mode.
+
+BATCH_NORMS = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+FOLDABLE = (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.Linear)
+
+def fold_batch_norm(layer, bn):
+    # bn(W x + b) = scale * (W x + b - mean) + beta, with scale = gamma / sqrt(var + eps)
+    if bn.running_mean is None:
+        raise Exception("cannot fold a batch norm without running statistics")
+
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    bias = shift if layer.bias is None else layer.bias * scale + shift
+
+    with torch.no_grad():
+        layer.weight = nn.Parameter(layer.weight * scale.view(-1, *([1] * (layer.weight.dim() - 1))))
+        layer.bias = nn.Parameter(bias.detach().clone())
+
+def remove_weight_norms(model):
+    for module in model.modules():
+        if parametrize.is_parametrized(module, "weight"):
+            parametrize.remove_parametrizations(module, "weight")
+        elif hasattr(module, "weight_g"):
+            nn.utils.remove_weight_norm(module)
+
+def eval_only(module, mode=True):
+    if mode:
+        raise Exception("a fused model only runs in eval mode")
+    return module
+
+def fuse_model(model):
+    # Returns a fused copy of <model> in eval mode with frozen parameters, <model> itself is left unchanged
+    # weight_norm keeps the weight of the last forward as a non-leaf tensor, which cannot be deep copied. The copy gets
+    # a detached clone through the memo of deepcopy instead, it is recomputed from weight_g/weight_v when the norm is removed.
+    memo = {id(module.weight): module.weight.detach().clone() for module in model.modules()
+            if hasattr(module, "weight_g") and isinstance(getattr(module, "weight", None), torch.Tensor)}
+    model = copy.deepcopy(model, memo).eval()
+    remove_weight_norms(model)
+
+    for module in list(model.modules()):
+        if isinstance(module, Unit3D) and module._use_batch_norm:
+            fold_batch_norm(module.conv3d, module.bn)
+            module._use_batch_norm = False
+            del module.bn
+        elif isinstance(module, nn.Sequential):
+            for i in range(1, len(module)):
+                if isinstance(module[i], BATCH_NORMS) and isinstance(module[i-1], FOLDABLE):
+                    fold_batch_norm(module[i-1], module[i])
+                    module[i] = nn.Identity()
+
+    model.requires_grad_(False)
+    for module in model.modules():
+        module.train = functools.partial(eval_only, module)
+    return model
@@ -12,7 +12,11 @@ from scipy.ndimage import rotate as rotate_img       #
 import random                                        #  OS
 import os                                            #
 
-WIDTH = HEIGHT = 128
+# Private Packages
+from frame_store import count_frames
+
+# Default height and width of the frames
+FRAME_SIZE = 128
 # Augmentations
 prob_50 = lambda aug: va.Sometimes(0.5, aug) # Used to apply augmentor with 50% probability
 prob_20 = lambda aug: va.Sometimes(0.2, aug) # Used to apply augmentor with 20% probability
@@ -38,29 +42,44 @@ def use_aug_seq(frames):
 
 class MoCoDataset(Dataset):
 
-    def __init__(self, data_folders, split, window_num, clip_num, frame_num, min_frame_num=25, max_vid_num=0):
+    def __init__(self, data_folders, split, window_num, clip_num, frame_num, min_frame_num=25, max_vid_num=0, frame_store=None, video_index=None, frame_size=FRAME_SIZE):
         self.window_num = window_num
         self.clip_num = clip_num
         self.frame_num = frame_num
+        self.frame_size = frame_size
+        self.frame_store = frame_store
+        self.video_index = video_index
         self.video_folders = []
-        
-        for data_folder in data_folders:
-            class_names = os.listdir(data_folder) if split == None else split
-            # class_names = [''] # Finegym
-            
+
+        # The index already knows every video and its length, so no folder is listed
+        if video_index is not None:
+            class_names = video_index.class_names() if split == None else split
             for class_name in class_names:
-                class_path = os.path.join(data_folder, class_name)
-                if not os.path.exists(class_path):
-                    continue
+                video_folders = video_index.videos(class_name, min_frame_num)
+                if len(video_folders) > max_vid_num and max_vid_num != 0:
+                    video_folders = random.sample(video_folders, max_vid_num)
+                self.video_folders.extend(video_folders)
+        else:
+            for data_folder in data_folders:
+                class_names = os.listdir(data_folder) if split == None else split
+                # class_names = [''] # Finegym
+            
+                for class_name in class_names:
+                    class_path = os.path.join(data_folder, class_name)
+                    if not os.path.exists(class_path):
+                        continue
 
-                video_names = os.listdir(class_path)
-                if len(video_names) > max_vid_num and max_vid_num != 0:
-                    video_names = random.sample(video_names, max_vid_num)
-                for video_name in video_names:
-                    video_folder = os.path.join(class_path, video_name)
+                    video_names = os.listdir(class_path)
+                    if len(video_names) > max_vid_num and max_vid_num != 0:
+                        video_names = random.sample(video_names, max_vid_num)
+                    for video_name in video_names:
+                        video_folder = os.path.join(class_path, video_name)
 
-                    if len(os.listdir(video_folder)) >= min_frame_num:
-                        self.video_folders.append(video_folder)
+                        if count_frames(video_folder, self.frame_store) >= min_frame_num:
+                            self.video_folders.append(video_folder)
+
+    def packed(self, video_folder):
+        return self.frame_store is not None and video_folder in self.frame_store
 
     def __len__(self):
         return len(self.video_folders)
@@ -68,10 +87,16 @@ class MoCoDataset(Dataset):
     def __getitem__(self, idx):
         video_folder = self.video_folders[idx]
 
-        all_frames = [os.path.join(video_folder, frame_name) for frame_name in os.listdir(video_folder)]
-        all_frames.sort()
+        if self.packed(video_folder):
+            length = self.frame_store.length(video_folder)
+        elif self.video_index is not None and video_folder in self.video_index:
+            all_frames = [os.path.join(video_folder, frame_name) for frame_name in self.video_index.frame_names(video_folder)]
+            length = len(all_frames)
+        else:
+            all_frames = [os.path.join(video_folder, frame_name) for frame_name in os.listdir(video_folder)]
+            all_frames.sort()
+            length = len(all_frames)
 
-        length = len(all_frames)
         stride = round((length - self.frame_num)/(self.clip_num*self.window_num-1))
         
         selected_frames = []
@@ -83,13 +108,21 @@ class MoCoDataset(Dataset):
         
         # Process frames
         processed_frames = [None] * length
-        for idx in selected_frames:
-            if processed_frames[idx] is None:
-                frame = all_frames[idx]
-                img = cv2.imread(frame)
-                img = cv2.resize(img, (WIDTH, HEIGHT))   
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if self.packed(video_folder):
+            unique_frames = sorted(set(selected_frames))
+            for idx, img in zip(unique_frames, self.frame_store.read(video_folder, unique_frames)):
+                # The store may be packed at another size than the decoded jpgs
+                if img.shape[:2] != (self.frame_size, self.frame_size):
+                    img = cv2.resize(img, (self.frame_size, self.frame_size))
                 processed_frames[idx] = img
+        else:
+            for idx in selected_frames:
+                if processed_frames[idx] is None:
+                    frame = all_frames[idx]
+                    img = cv2.imread(frame)
+                    img = cv2.resize(img, (self.frame_size, self.frame_size))   
+                    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                    processed_frames[idx] = img
 
         frames = []
         for i, frame_idx in enumerate(selected_frames):
@@ -125,10 +158,11 @@ class MoCoDataset(Dataset):
 
 class HumanNonhumanDataset(Dataset):
 
-    def __init__(self, h_data_folders, n_data_folders, split, window_num, clip_num, frame_num, min_frame_num=25, max_vid_num=0):
+    def __init__(self, h_data_folders, n_data_folders, split, window_num, clip_num, frame_num, min_frame_num=25, max_vid_num=0, frame_size=FRAME_SIZE):
         self.window_num = window_num
         self.clip_num = clip_num
         self.frame_num = frame_num
+        self.frame_size = frame_size
         self.video_folders = []
         
         for data_folder in h_data_folders:
@@ -186,7 +220,7 @@ class HumanNonhumanDataset(Dataset):
                 if processed_frames[idx] is None:
                     frame = all_frames[idx]
                     img = cv2.imread(frame)
-                    img = cv2.resize(img, (WIDTH, HEIGHT))   
+                    img = cv2.resize(img, (self.frame_size, self.frame_size))   
                     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
                     if rotate in [1,2]:
                         img = rotate_img(img, angle, reshape=False)
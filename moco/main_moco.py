@@ -8,6 +8,7 @@ import random
 import shutil
 import time
 import warnings
+from functools import partial
 
 import torch
 import torch.nn as nn
@@ -25,6 +26,8 @@ import torchvision.models as models
 from dataset import MoCoDataset as MCDset
 from dataset import HumanNonhumanDataset as HNDset
 from moco_encoder import C3D_TCN
+from frame_store import FrameStore
+from video_index import load_video_index
 
 import moco.loader
 import moco.builder
@@ -98,6 +101,16 @@ parser.add_argument('--aug-plus', action='store_true',
                     help='use moco v2 data augmentation')
 parser.add_argument('--cos', action='store_true',
                     help='use cosine lr schedule')
+parser.add_argument('--head', default='flatten', type=str, choices=['flatten', 'avg', 'bottleneck'],
+                    help='head between the encoder and the TCN (default: flatten, the original layout)')
+parser.add_argument('--frame-size', '--frame_size', default=128, type=int, metavar='N',
+                    help='height and width of the input frames, the same as for train.py (default: 128)')
+parser.add_argument('--frame-num', '--frame_num', default=10, type=int, metavar='N',
+                    help='number of frames per clip, the same as for train.py (default: 10)')
+parser.add_argument('--frame-store', default='', type=str, metavar='PATH',
+                    help='path to a packed frame store (default: decode jpgs)')
+parser.add_argument('--video-index', default='', type=str, metavar='PATH',
+                    help='path to a cached video index, built if missing or stale (default: list folders)')
 
 DATA_FOLDERS = ["<TRAINING_SET_DIR>",
                 "<VALIDATION_SET_DIR>",
@@ -120,7 +133,6 @@ SPLIT = read_split(SPLIT)
 
 WINDOW_NUM = 3
 CLIP_NUM = 5 
-FRAME_NUM = 10
 
 def main():
     args = parser.parse_args()
@@ -181,7 +193,7 @@ def main_worker(gpu, ngpus_per_node, args):
     # create model
     print("=> creating model '{}'".format(args.arch))
     model = moco.builder.MoCo(
-        C3D_TCN,
+        partial(C3D_TCN, head=args.head, frame_num=args.frame_num, frame_size=args.frame_size),
         args.moco_dim, args.moco_k, args.moco_m, args.moco_t, args.mlp)
     # print(model)
 
@@ -268,8 +280,10 @@ def main_worker(gpu, ngpus_per_node, args):
     #         normalize
     #     ]
 
-    train_dataset = MCDset(DATA_FOLDERS, SPLIT, WINDOW_NUM, CLIP_NUM, FRAME_NUM, min_frame_num=10)
-    # train_dataset = HNDset(H_FOLDERS, N_FOLDERS, SPLIT, WINDOW_NUM, CLIP_NUM, FRAME_NUM, min_frame_num=20)
+    frame_store = FrameStore(args.frame_store) if args.frame_store else None
+    video_index = load_video_index(args.video_index, {"name": "moco", "folders": DATA_FOLDERS}) if args.video_index else None
+    train_dataset = MCDset(DATA_FOLDERS, SPLIT, WINDOW_NUM, CLIP_NUM, args.frame_num, min_frame_num=10, frame_store=frame_store, video_index=video_index, frame_size=args.frame_size)
+    # train_dataset = HNDset(H_FOLDERS, N_FOLDERS, SPLIT, WINDOW_NUM, CLIP_NUM, args.frame_num, min_frame_num=20, frame_size=args.frame_size)
 
     if args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
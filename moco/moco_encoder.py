@@ -9,11 +9,11 @@ import os
 
 class C3D_TCN(nn.Module):
 
-    def __init__(self, tcn_out_channel=64, c3d_path='', tcn_path=''):
+    def __init__(self, tcn_out_channel=64, c3d_path='', tcn_path='', head="flatten", frame_num=10, frame_size=128):
         super(C3D_TCN, self).__init__()
 
-        self.c3d = C3D(in_channels=3) 
-        self.tcn = TCN(245760, [128,128,64,tcn_out_channel]) # 245760 == 128, 983040 == 256, 384000 == 160
+        self.c3d = C3D(in_channels=3, head=head, frame_num=frame_num, frame_size=frame_size)
+        self.tcn = TCN(self.c3d.output_dim, [128,128,64,tcn_out_channel]) # flatten: 245760 == 128, 983040 == 256, 384000 == 160
 
         self.load_models(c3d_path, tcn_path)
 
@@ -0,0 +1,193 @@
+# Public Packages
+import torch                                         #  Torch
+import torch.nn as nn                                #
+
+import numpy as np                                   #  Numpy
+
+import argparse                                      #
+import json                                          #  OS
+import os                                            #
+import tempfile                                      #
+
+# Private Packages
+from encoder import HEADS
+from fuse import fuse_model
+from pipeline import FewShotPipeline, build_pipeline_models, load_pipeline_models, QUERY_NUM
+from utils import normalize_clips, episode_splits, stack_splits
+
+ENCODER_NAME = "encoder.onnx"
+HEAD_NAME = "head.onnx"
+CONFIG_NAME = "config.json"
+
+# An ONNX export is a folder of two graphs and their config:
+#   encoder.onnx  C3D+TCN, clips [video, window*clip, RGB, frame, H, W] -> embeddings [video, window*clip, feature]
+#   head.onnx     attention pooling+relation, support [episode, class*sample*window, clip, feature] and
+#                 query [episode, query*class*window, clip, feature] -> relations and probabilities
+# The video, episode and query axes are dynamic, way, shot and the clip shape are fixed by the config.
+# onnxruntime is only imported by the runtime, exporting needs the onnx package of torch.onnx.export.
+
+def import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise Exception("the onnx backend needs onnxruntime, e.g. pip install onnxruntime")
+    return onnxruntime
+
+class EncoderGraph(nn.Module):
+    def __init__(self, pipeline):
+        super(EncoderGraph, self).__init__()
+        self.pipeline = pipeline
+
+    def forward(self, data):
+        # Same as FewShotPipeline.encode with a dynamic number of videos
+        p = self.pipeline
+        embed = p.c3d(data.reshape(-1, 3, p.frame_num, p.frame_size, p.frame_size))
+        embed = embed.reshape(data.shape[0], p.window_num*p.clip_num, -1)  # [video, window*clip, feature]
+        embed = torch.transpose(p.tcn(torch.transpose(embed, 1, 2)), 1, 2)
+        return embed
+
+class HeadGraph(nn.Module):
+    def __init__(self, pipeline):
+        super(HeadGraph, self).__init__()
+        self.pipeline = pipeline
+
+    def forward(self, samples, batches):
+        # Same as FewShotPipeline.relate on split embeddings, pool_episodes and relate_pooled keep the episode and query axes dynamic
+        p = self.pipeline
+        return p.relate_pooled(p.ap.pool_episodes(samples, batches), batches)
+
+def export_onnx(pipeline, out_dir, config, opset=18):
+    # Exports the fused pipeline as encoder.onnx and head.onnx, traced on a dummy episode
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    pipeline = fuse_model(pipeline).cpu()
+
+    class_num, sample_num, query_num = config["way"], config["shot"], config["query"]
+    data = torch.zeros(class_num*(sample_num+query_num), config["window_num"]*config["clip_num"], 3, config["frame_num"], config["frame_size"], config["frame_size"])
+    with torch.no_grad():
+        embed = pipeline.encode(data)
+    samples = embed[:class_num*sample_num].reshape(1, class_num*sample_num*config["window_num"], config["clip_num"], -1)
+    batches = embed[class_num*sample_num:].reshape(1, class_num*query_num*config["window_num"], config["clip_num"], -1)
+
+    torch.onnx.export(EncoderGraph(pipeline).eval(), (data,), os.path.join(out_dir, ENCODER_NAME), opset_version=opset,
+                      input_names=["clips"], output_names=["embeddings"],
+                      dynamic_axes={"clips": {0: "video"}, "embeddings": {0: "video"}})
+    torch.onnx.export(HeadGraph(pipeline).eval(), (samples, batches), os.path.join(out_dir, HEAD_NAME), opset_version=opset,
+                      input_names=["support", "query"], output_names=["relations", "probabilities"],
+                      dynamic_axes={"support": {0: "episode"}, "query": {0: "episode", 1: "query"},
+                                    "relations": {0: "episode_query"}, "probabilities": {0: "episode_query"}})
+
+    with open(os.path.join(out_dir, CONFIG_NAME), "w") as file:
+        file.write(json.dumps(config))
+
+class OnnxPipeline(object):
+    '''
+    ONNX Runtime backend with the encode/relate/forward interface of FewShotPipeline, on torch tensors
+    Sessions run on the CPU with all graph optimizations, <threads> sets the intra-op threads, onnxruntime's default if None
+    '''
+    def __init__(self, onnx_dir, threads=None):
+        ort = import_onnxruntime()
+        with open(os.path.join(onnx_dir, CONFIG_NAME), "r") as file:
+            self.config = json.loads(file.read())
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.encoder = ort.InferenceSession(os.path.join(onnx_dir, ENCODER_NAME), options, providers=["CPUExecutionProvider"])
+        self.head = ort.InferenceSession(os.path.join(onnx_dir, HEAD_NAME), options, providers=["CPUExecutionProvider"])
+
+    def encode(self, data):
+        # [video, window*clip, RGB, frame, H, W] -> [video, window*clip, feature]
+        data = normalize_clips(data.cpu()).float()
+        embed, = self.encoder.run(None, {"clips": np.ascontiguousarray(data.numpy())})
+        return torch.from_numpy(embed)
+
+    def relate(self, embed, support_index, query_index):
+        # [episode*class*(support+query), window*clip, feature] -> relations, probabilities
+        class_num, sample_num = self.config["way"], self.config["shot"]
+        episode_num = int(support_index.shape[0]) // (class_num*sample_num)
+        query_num = int(query_index.shape[0]) // (episode_num*class_num)  # the query axis of head.onnx is dynamic
+        window_num, clip_num = self.config["window_num"], self.config["clip_num"]
+
+        embed = embed.cpu()
+        samples = embed[support_index.cpu()].reshape(episode_num, class_num*sample_num*window_num, clip_num, -1)  # [episode, class*sample*window, clip, feature]
+        batches = embed[query_index.cpu()].reshape(episode_num, class_num*query_num*window_num, clip_num, -1)     # [episode, query*class*window, clip, feature]
+        relations, final_outcome = self.head.run(None, {"support": np.ascontiguousarray(samples.numpy()), "query": np.ascontiguousarray(batches.numpy())})
+        return torch.from_numpy(relations), torch.from_numpy(final_outcome)
+
+    def __call__(self, data, support_index, query_index):
+        return self.relate(self.encode(data), support_index, query_index)
+
+def check_parity(pipeline, onnx_pipeline, episode_num=2, seed=0):
+    # Max absolute difference of embeddings, relations and probabilities between eager and onnx on random clips
+    config = onnx_pipeline.config
+    class_num, sample_num, query_num = config["way"], config["shot"], config["query"]
+    generator = torch.Generator().manual_seed(seed)
+    data = torch.rand(episode_num*class_num*(sample_num+query_num), config["window_num"]*config["clip_num"], 3, config["frame_num"], config["frame_size"], config["frame_size"], generator=generator) * 2 - 1
+    support_index, query_index = episode_splits(episode_num, class_num, sample_num, query_num, generator)
+    support_index, query_index = stack_splits(list(zip(support_index, query_index)), class_num*(sample_num+query_num))
+
+    pipeline = pipeline.cpu().eval()
+    with torch.no_grad():
+        embed = pipeline.encode(data)
+        relations, final_outcome = pipeline.relate(embed, support_index, query_index)
+    onnx_embed = onnx_pipeline.encode(data)
+    onnx_relations, onnx_final_outcome = onnx_pipeline.relate(onnx_embed, support_index, query_index)
+
+    return {"embeddings": (embed - onnx_embed).abs().max().item(),
+            "relations": (relations - onnx_relations).abs().max().item(),
+            "probabilities": (final_outcome - onnx_final_outcome).abs().max().item()}
+
+def check_heads_parity(config, opset=18, seed=0):
+    # check_parity of randomly initialized pipelines for every encoder head, exported with the way, shot and clip shape of <config>
+    differences = {}
+    for head in HEADS:
+        torch.manual_seed(seed)
+        c3d, tcn, ap, rn = build_pipeline_models(config["way"], config["shot"], config["window_num"], config["clip_num"], config["frame_num"], config["frame_size"], head)
+        pipeline = FewShotPipeline(c3d, tcn, ap, rn, config["way"], config["shot"], config["query"], config["window_num"], config["clip_num"],
+                                   config["frame_num"], config["frame_size"], config["relation"])
+        with tempfile.TemporaryDirectory() as onnx_dir:
+            export_onnx(pipeline, onnx_dir, dict(config, head=head), opset)
+            differences[head] = check_parity(pipeline, OnnxPipeline(onnx_dir), episode_num=1, seed=seed)
+    return differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--checkpoint", help="path of the checkpoint to export", required=True)
+    parser.add_argument("-o", "--output", help="folder to write the onnx graphs into", required=True)
+    parser.add_argument("-w", "--way", help="number of classes", type=int, default=3)
+    parser.add_argument("-s", "--shot", help="number of shots", type=int, default=5)
+    parser.add_argument("--frame_size", help="height and width of the input frames", type=int, default=128)
+    parser.add_argument("--frame_num", help="number of frames per clip", type=int, default=10)
+    parser.add_argument("--clip_num", help="number of clips per window", type=int, default=5)
+    parser.add_argument("--window_num", help="number of windows per video", type=int, default=3)
+    parser.add_argument("--head", help="head between the encoder and the TCN", choices=["flatten", "avg", "bottleneck"], default="flatten")
+    parser.add_argument("--relation", help="relation between pooled support and query, cos is what test.py scores with", choices=["rn", "cos"], default="cos")
+    parser.add_argument("--opset", help="onnx opset version", type=int, default=18)
+    parser.add_argument("--check_heads", help="whether to also export and check randomly initialized models of every encoder head, to test exporter coverage", action="store_true")
+    parser.add_argument("--tolerance", help="maximum absolute difference to the eager outputs accepted by the parity check", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.checkpoint):
+        raise Exception("invalid checkpoint path: {}".format(args.checkpoint))
+
+    config = {"way": args.way, "shot": args.shot, "query": QUERY_NUM, "frame_size": args.frame_size, "frame_num": args.frame_num,
+              "clip_num": args.clip_num, "window_num": args.window_num, "head": args.head, "relation": args.relation}
+    c3d, tcn, ap, rn = load_pipeline_models(args.checkpoint, args.way, args.shot, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.head)
+    pipeline = FewShotPipeline(c3d, tcn, ap, rn, args.way, args.shot, QUERY_NUM, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.relation)
+    export_onnx(pipeline, args.output, config, args.opset)
+
+    # Parity of the exported graphs against the eager models in eval mode
+    differences = check_parity(pipeline, OnnxPipeline(args.output))
+    print("Exported {} to {}, max abs difference to eager {}".format(json.dumps(config), args.output, json.dumps(differences)))
+    if max(differences.values()) > args.tolerance:
+        raise Exception("onnx outputs differ from the eager outputs by more than {}".format(args.tolerance))
+
+    # Same parity for every encoder head, so that a head the exporter cannot translate fails before it is deployed
+    if args.check_heads:
+        head_differences = check_heads_parity(config, args.opset)
+        print("Head parity {}".format(json.dumps(head_differences)))
+        for head, head_difference in head_differences.items():
+            if max(head_difference.values()) > args.tolerance:
+                raise Exception("onnx outputs of the {} head differ from the eager outputs by more than {}".format(head, args.tolerance))
@@ -0,0 +1,166 @@
+# Public Packages
+import torch                                         #  Torch
+import torch.nn as nn                                #
+
+import argparse                                      #
+import json                                          #  OS
+import os                                            #
+
+# Private Packages
+from relation_net import RelationNetwork as RN
+from encoder import Simple3DEncoder as C3D
+from tcn import TemporalConvNet as TCN
+from attention_pool import AttentionPooling as AP
+from fuse import fuse_model
+from utils import normalize_clips, episode_splits, stack_splits
+
+QUERY_NUM = 5   # Num of instances for query per class
+TCN_OUT = 64    # Num of channels of output of TCN
+CONFIG_NAME = "config.json"
+
+# An exported pipeline is a traced TorchScript module saved with its config as an extra file, so it is loaded by
+# torch.jit.load alone, without this repo. Tracing specializes it to the config: way, shot, clip shape and the
+# number of stacked episodes are fixed, and the splits are inputs.
+
+class FewShotPipeline(nn.Module):
+    '''
+    Encoding, attention pooling, relation and final probabilities of test.py as one module
+    param:data            shape [episode*class*(support+query), window*clip, RGB, frame, H, W], uint8 or normalized
+    param:support_index   shape [episode*class*support], stacked splits
+    param:query_index     shape [episode*class*query], stacked splits
+    return:               relations [episode*query*class, window, class], probabilities [episode*query*class, window, class+1]
+    '''
+    def __init__(self, c3d, tcn, ap, rn, class_num, sample_num, query_num, window_num, clip_num, frame_num, frame_size, relation="rn"):
+        super(FewShotPipeline, self).__init__()
+        self.c3d = c3d
+        self.tcn = tcn
+        self.ap = ap
+        self.rn = rn
+        self.class_num = class_num
+        self.sample_num = sample_num
+        self.query_num = query_num
+        self.window_num = window_num
+        self.clip_num = clip_num
+        self.frame_num = frame_num
+        self.frame_size = frame_size
+        self.relation = relation
+
+    def encode(self, data):
+        # [video, window*clip, RGB, frame, H, W] -> [video, window*clip, feature]
+        video_num = int(data.shape[0])
+        embed = self.c3d(normalize_clips(data.reshape(-1, 3, self.frame_num, self.frame_size, self.frame_size)))
+        embed = embed.reshape(video_num, self.window_num*self.clip_num, -1)  # [video, window*clip, feature]
+
+        # TCN Processing
+        embed = torch.transpose(embed, 1, 2)           # [video, feature(channel), window*clip(length)]
+        embed = self.tcn(embed)
+        embed = torch.transpose(embed, 1, 2)           # [video, window*clip, feature]
+        return embed
+
+    def relate(self, embed, support_index, query_index):
+        # [episode*class*(support+query), window*clip, feature] -> relations, probabilities
+        episode_num = int(support_index.shape[0]) // (self.class_num*self.sample_num)
+
+        # Split data into support & query
+        samples = embed[support_index].reshape(episode_num, self.class_num*self.sample_num*self.window_num, self.clip_num, -1)  # [episode, class*sample*window, clip, feature]
+        batches = embed[query_index].reshape(episode_num, self.class_num*self.query_num*self.window_num, self.clip_num, -1)     # [episode, query*class*window, clip, feature]
+
+        # Attention Pooling
+        samples = self.ap.forward_episodes(samples, batches)                  # [episode, query*class*window, class, clip, feature]
+        return self.relate_pooled(samples, batches)
+
+    def relate_pooled(self, samples, batches):
+        # Pooled support [episode, query*class*window, class, clip, feature] and query [episode, query*class*window, clip, feature]
+        # -> relations, probabilities. No shape is turned into an int, so that exported graphs keep the episode and query axes dynamic
+        samples = samples.reshape(-1, self.class_num, self.clip_num, samples.shape[4])  # [episode*query*class*window, class, clip, feature]
+        batches = batches.reshape(-1, self.clip_num, batches.shape[3])                  # [episode*query*class*window, clip, feature]
+
+        # Compute Relation
+        if self.relation == "rn":
+            relations = self.rn.forward_factorized(samples, batches)          # [episode*query*class*window*class, 1]
+        else:
+            samples = samples.reshape(samples.shape[0], self.class_num, -1)
+            batches = batches.reshape(batches.shape[0], 1, -1)
+            relations = nn.functional.cosine_similarity(samples, batches, dim=2)  # [episode*query*class*window, class]
+        relations = relations.float().reshape(-1, self.window_num, self.class_num)  # [episode*query*class, window, class]
+
+        # Generate final probabilities, in float32 also under bfloat16 autocast
+        blank_prob = torch.ones_like(relations[:, :, :1])
+        relations_ctc = torch.cat((blank_prob, relations), 2)
+        final_outcome = nn.functional.softmax(relations_ctc, 2)             # [episode*query*class, window(length), class+1]
+        return relations, final_outcome
+
+    def forward(self, data, support_index, query_index):
+        return self.relate(self.encode(data), support_index, query_index)
+
+def build_pipeline_models(class_num, sample_num, window_num, clip_num, frame_num, frame_size, head="flatten", channels_last=False):
+    c3d = C3D(in_channels=3, head=head, frame_num=frame_num, frame_size=frame_size, channels_last=channels_last)
+    tcn = TCN(c3d.output_dim, [128,128,64,TCN_OUT])
+    ap = AP(class_num, sample_num, QUERY_NUM, window_num, clip_num, TCN_OUT)
+    rn = RN(clip_num, hidden_size=32, feature_dim=TCN_OUT)
+    return c3d, tcn, ap, rn
+
+def load_pipeline_models(checkpoint, class_num, sample_num, window_num, clip_num, frame_num, frame_size, head="flatten", channels_last=False):
+    c3d, tcn, ap, rn = build_pipeline_models(class_num, sample_num, window_num, clip_num, frame_num, frame_size, head, channels_last)
+
+    # c3d is saved from inside nn.DataParallel by train.py
+    nn.DataParallel(c3d).load_state_dict(torch.load(os.path.join(checkpoint, "c3d.pkl"), map_location="cpu"))
+    tcn.load_state_dict(torch.load(os.path.join(checkpoint, "tcn.pkl"), map_location="cpu"))
+    ap.load_state_dict(torch.load(os.path.join(checkpoint, "ap.pkl"), map_location="cpu"))
+    rn.load_state_dict(torch.load(os.path.join(checkpoint, "rn.pkl"), map_location="cpu"))
+    return c3d, tcn, ap, rn
+
+def export_pipeline(pipeline, path, config, device=torch.device("cpu")):
+    # Traces the fused pipeline on a dummy batch of config["episodes"] episodes and saves it with its config
+    class_num, sample_num = config["way"], config["shot"]
+    episode_size = class_num*(sample_num+config["query"])
+    data = torch.zeros(config["episodes"]*episode_size, config["window_num"]*config["clip_num"], 3, config["frame_num"], config["frame_size"], config["frame_size"],
+                       dtype=torch.uint8 if config["uint8"] else torch.float)
+    support_index, query_index = episode_splits(config["episodes"], class_num, sample_num, config["query"])
+    support_index, query_index = stack_splits(list(zip(support_index, query_index)), episode_size)
+    inputs = (data.to(device), support_index.to(device), query_index.to(device))
+
+    pipeline = fuse_model(pipeline).to(device)
+    with torch.no_grad():
+        # Freezing inlines the weights and folds the constants of the graph
+        traced = torch.jit.freeze(torch.jit.trace(pipeline, inputs, check_trace=False))
+    torch.jit.save(traced, path, _extra_files={CONFIG_NAME: json.dumps(config)})
+    return traced
+
+def load_pipeline(path, device=torch.device("cpu")):
+    extra_files = {CONFIG_NAME: ""}
+    pipeline = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    # The oneDNN fusions of the CPU graph cannot be saved, they are applied after loading
+    if device.type == "cpu":
+        pipeline = torch.jit.optimize_for_inference(pipeline)
+    return pipeline, json.loads(extra_files[CONFIG_NAME])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--checkpoint", help="path of the checkpoint to export", required=True)
+    parser.add_argument("-o", "--output", help="path of the exported pipeline", required=True)
+    parser.add_argument("-w", "--way", help="number of classes", type=int, default=3)
+    parser.add_argument("-s", "--shot", help="number of shots", type=int, default=5)
+    parser.add_argument("--frame_size", help="height and width of the input frames", type=int, default=128)
+    parser.add_argument("--frame_num", help="number of frames per clip", type=int, default=10)
+    parser.add_argument("--clip_num", help="number of clips per window", type=int, default=5)
+    parser.add_argument("--window_num", help="number of windows per video", type=int, default=3)
+    parser.add_argument("--head", help="head between the encoder and the TCN", choices=["flatten", "avg", "bottleneck"], default="flatten")
+    parser.add_argument("--episodes", help="number of episodes stacked into one call of the pipeline", type=int, default=1)
+    parser.add_argument("--relation", help="relation between pooled support and query, cos is what test.py scores with", choices=["rn", "cos"], default="cos")
+    parser.add_argument("--uint8", help="whether the pipeline takes uint8 clips and normalizes them itself", action="store_true")
+    parser.add_argument("--device", help="device the pipeline is traced and optimized for", choices=["cpu", "cuda"], default="cpu")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.checkpoint):
+        raise Exception("invalid checkpoint path: {}".format(args.checkpoint))
+    if args.episodes <= 0:
+        raise Exception("episodes per call must be positive")
+
+    config = {"way": args.way, "shot": args.shot, "query": QUERY_NUM, "frame_size": args.frame_size, "frame_num": args.frame_num,
+              "clip_num": args.clip_num, "window_num": args.window_num, "head": args.head, "episodes": args.episodes,
+              "relation": args.relation, "uint8": args.uint8}
+    c3d, tcn, ap, rn = load_pipeline_models(args.checkpoint, args.way, args.shot, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.head)
+    pipeline = FewShotPipeline(c3d, tcn, ap, rn, args.way, args.shot, QUERY_NUM, args.window_num, args.clip_num, args.frame_num, args.frame_size, args.relation)
+    export_pipeline(pipeline, args.output, config, torch.device(args.device))
+    print("Exported {} to {}".format(json.dumps(config), args.output))
@@ -0,0 +1,224 @@
+# Public Packages
+import torch                                         #  Torch
+import torch.nn as nn                                #
+import torch.nn.functional as F                      #
+import torch.ao.nn.intrinsic as nni                  #
+import torch.ao.nn.quantized.dynamic as nnqd         #
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, default_dynamic_qconfig, prepare, convert, quantize_dynamic
+
+import numpy as np                                   #  Numpy
+
+import argparse                                      #
+import io                                            #
+import json                                          #
+import os                                            #  OS
+import time                                          #
+
+# Private Packages
+from encoder import Unit3D
+from tcn import TemporalBlock
+from fuse import fuse_model
+from pipeline import FewShotPipeline, build_pipeline_models, load_pipeline_models, QUERY_NUM
+from frame_store import FrameStore
+from video_index import load_video_index, index_path
+from utils import EpisodeSplitSchedule, stack_splits, ctc_predict_single
+import dataset
+
+CHECKPOINT_NAME = "pipeline_int8.pkl"
+CONFIG_NAME = "config.json"
+
+# Post-training int8 quantization of a FewShotPipeline for CPU inference, on top of fuse.py:
+#   Unit3D convs (batch norm folded)   static, activations observed on a few calibration episodes
+#   Linear and Conv1d of TCN, AP, RN   dynamic, activations quantized on the fly
+# The first conv of the relation network stays in float, RelationNetwork.forward_factorized reads its weight.
+# A quantized checkpoint is the state dict of the whole pipeline with its config, see load_quantized.
+
+# Modules read directly by their parents, which quantized modules do not support
+FLOAT_MODULES = ["rn.layer1.0"]
+
+class QuantizedUnit3D(nn.Module):
+    '''
+    Unit3D with its batch norm folded, the padded input is quantized and the conv (and ReLU) run in int8
+    The 'same' padding is done on the float input, the quantized conv itself does not pad
+    '''
+    compute_pad = Unit3D.compute_pad
+    static_padding = Unit3D.static_padding
+
+    def __init__(self, unit):
+        super(QuantizedUnit3D, self).__init__()
+        if unit._use_batch_norm:
+            raise Exception("fold the batch norms of the encoder with fuse_model before quantizing it")
+        self._kernel_shape = unit._kernel_shape
+        self._stride = unit._stride
+        self._padding = dict()
+
+        self.quant = QuantStub()
+        if unit._activation_fn is F.relu:
+            self.conv = nni.ConvReLU3d(unit.conv3d, nn.ReLU())
+            self._activation_fn = None
+        else:
+            self.conv = unit.conv3d
+            self._activation_fn = unit._activation_fn
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        (batch, channel, t, h, w) = x.size()
+        pad, padding = self.static_padding(t, h, w)
+        if pad is None and max(padding) > 0:
+            pad = (padding[2], padding[2], padding[1], padding[1], padding[0], padding[0])
+        if pad is not None:
+            x = F.pad(x, pad)
+
+        x = self.dequant(self.conv(self.quant(x)))
+        if self._activation_fn is not None:
+            x = self._activation_fn(x)
+        return x
+
+def replace_units(module):
+    for name, child in module.named_children():
+        if isinstance(child, Unit3D):
+            setattr(module, name, QuantizedUnit3D(child))
+        else:
+            replace_units(child)
+
+def dynamic_qconfig_spec(pipeline):
+    # Linear and Conv1d layers outside the encoder, by name
+    return {name: default_dynamic_qconfig for name, module in pipeline.named_modules()
+            if isinstance(module, (nn.Linear, nn.Conv1d)) and not name.startswith("c3d.") and name not in FLOAT_MODULES}
+
+def quantize_pipeline(pipeline, calibration=(), engine="x86"):
+    '''
+    Returns an int8 copy of <pipeline>, <pipeline> itself is left unchanged
+    param:calibration   clips of a few episodes, [video, window*clip, RGB, frame, H, W] each, passed through the encoder
+                        to observe the ranges of its activations, empty when the ranges are loaded from a checkpoint
+    '''
+    torch.backends.quantized.engine = engine
+    pipeline = fuse_model(pipeline.cpu())
+
+    # Static quantization of the encoder
+    replace_units(pipeline.c3d)
+    for module in pipeline.c3d.modules():
+        if isinstance(module, QuantizedUnit3D):
+            module.qconfig = get_default_qconfig(engine)
+    prepare(pipeline, inplace=True)
+    with torch.no_grad():
+        for data in calibration:
+            pipeline.encode(data)
+    convert(pipeline, inplace=True)
+
+    # Dynamic quantization of the rest
+    pipeline = quantize_dynamic(pipeline, dynamic_qconfig_spec(pipeline), mapping={nn.Linear: nnqd.Linear, nn.Conv1d: nnqd.Conv1d})
+
+    # A module shared by two parents is swapped into two copies, and quantized weights are not shared when saved.
+    # TemporalBlock only runs its net, so its own references to the convs are dropped.
+    for module in pipeline.tcn.modules():
+        if isinstance(module, TemporalBlock):
+            del module.conv1, module.conv2
+    return pipeline
+
+def build_pipeline(config, checkpoint=None):
+    # Float pipeline of <config>, with the weights of <checkpoint> or random ones to load a state dict into
+    models = (config["way"], config["shot"], config["window_num"], config["clip_num"], config["frame_num"], config["frame_size"], config["head"])
+    c3d, tcn, ap, rn = load_pipeline_models(checkpoint, *models) if checkpoint is not None else build_pipeline_models(*models)
+    return FewShotPipeline(c3d, tcn, ap, rn, config["way"], config["shot"], config["query"], config["window_num"], config["clip_num"],
+                           config["frame_num"], config["frame_size"], config["relation"])
+
+def save_quantized(pipeline, out_dir, config):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    torch.save(pipeline.state_dict(), os.path.join(out_dir, CHECKPOINT_NAME))
+    with open(os.path.join(out_dir, CONFIG_NAME), "w") as file:
+        file.write(json.dumps(config))
+
+def load_quantized(out_dir):
+    # Rebuilds the quantized structure without calibration, scales and zero points come with the state dict
+    with open(os.path.join(out_dir, CONFIG_NAME), "r") as file:
+        config = json.loads(file.read())
+    pipeline = quantize_pipeline(build_pipeline(config), engine=config["engine"])
+    pipeline.load_state_dict(torch.load(os.path.join(out_dir, CHECKPOINT_NAME)))
+    return pipeline, config
+
+def state_size(module):
+    # Bytes of the saved state dict
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+def load_episode(video_dataset, episode):
+    data = torch.stack([video_dataset[idx][0] for idx in episode])    # [class*(support+query), window*clip, RGB, frame, H, W]
+    data_labels = dataset.episode_labels(torch.tensor([video_dataset.video_labels[idx] for idx in episode]))
+    return data, data_labels
+
+def episode_accuracy(pipeline, data, data_labels, support_index, query_index):
+    with torch.no_grad():
+        _, final_outcome = pipeline(data, support_index, query_index)
+    predict_labels = ctc_predict_single(final_outcome)
+    batches_labels = data_labels[query_index].numpy()
+    return np.mean([predict_labels[i] == batches_labels[i] for i in range(len(predict_labels))])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", help="path of the dataset json file, its train split calibrates and its test split is evaluated", required=True)
+    parser.add_argument("-c", "--checkpoint", help="path of the checkpoint to quantize", required=True)
+    parser.add_argument("-o", "--output", help="folder to write the quantized checkpoint into", required=True)
+    parser.add_argument("-w", "--way", help="number of classes", type=int, default=3)
+    parser.add_argument("-s", "--shot", help="number of shots", type=int, default=5)
+    parser.add_argument("--frame_size", help="height and width of the input frames", type=int, default=128)
+    parser.add_argument("--frame_num", help="number of frames per clip", type=int, default=10)
+    parser.add_argument("--clip_num", help="number of clips per window", type=int, default=5)
+    parser.add_argument("--window_num", help="number of windows per video", type=int, default=3)
+    parser.add_argument("--head", help="head between the encoder and the TCN", choices=["flatten", "avg", "bottleneck"], default="flatten")
+    parser.add_argument("--relation", help="relation between pooled support and query, cos is what test.py scores with", choices=["rn", "cos"], default="cos")
+    parser.add_argument("--frame_store", help="path of a frame store packed by frame_store.py, decode jpgs if not specified")
+    parser.add_argument("--calibration_ep", help="number of train episodes observed to calibrate the encoder", type=int, default=8)
+    parser.add_argument("--test_ep", help="number of episodes both models are evaluated on", type=int, default=100)
+    parser.add_argument("--seed", help="seed of the calibration and test episodes and their splits", type=int, default=0)
+    parser.add_argument("--engine", help="quantized engine", choices=["x86", "fbgemm", "qnnpack", "onednn"], default="x86")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dataset):
+        raise Exception("invalid dataset path: {}".format(args.dataset))
+    if not os.path.exists(args.checkpoint):
+        raise Exception("invalid checkpoint path: {}".format(args.checkpoint))
+    if args.calibration_ep <= 0 or args.test_ep <= 0:
+        raise Exception("calibration and test episodes must be positive")
+    with open(args.dataset, "r") as file:
+        dataset_info = json.loads(file.readline())
+
+    config = {"way": args.way, "shot": args.shot, "query": QUERY_NUM, "frame_size": args.frame_size, "frame_num": args.frame_num,
+              "clip_num": args.clip_num, "window_num": args.window_num, "head": args.head, "relation": args.relation, "engine": args.engine}
+    class_num, sample_num = args.way, args.shot
+
+    # Fixed episodes, calibration only sees the train split so that the int8 ranges are not fit to the evaluated videos
+    frame_store = FrameStore(args.frame_store) if args.frame_store is not None else None
+    video_index = load_video_index(index_path(args.dataset), dataset_info)
+    calibration_dataset = dataset.get_video_dataset(dataset_info, "train", video_index, args.frame_num, args.clip_num, args.window_num, sample_num+QUERY_NUM, frame_store, True, args.frame_size)
+    test_dataset = dataset.get_video_dataset(dataset_info, "test", video_index, args.frame_num, args.clip_num, args.window_num, sample_num+QUERY_NUM, frame_store, True, args.frame_size)
+    calibration_sampler = iter(dataset.EpisodicBatchSampler(calibration_dataset.video_labels, class_num, sample_num+QUERY_NUM, args.seed))
+    calibration_episodes = [next(calibration_sampler) for _ in range(args.calibration_ep)]
+    test_sampler = iter(dataset.EpisodicBatchSampler(test_dataset.video_labels, class_num, sample_num+QUERY_NUM, args.seed + 1))
+    test_episodes = [next(test_sampler) for _ in range(args.test_ep)]
+    test_splits = EpisodeSplitSchedule(class_num, sample_num, QUERY_NUM, args.test_ep, args.seed)
+
+    # Quantize
+    pipeline = build_pipeline(config, args.checkpoint).eval()
+    quantized = quantize_pipeline(pipeline, (load_episode(calibration_dataset, episode)[0] for episode in calibration_episodes), args.engine)
+    save_quantized(quantized, args.output, config)
+    float_size, quantized_size = state_size(pipeline), state_size(quantized)
+    print("Checkpoint size float = {:.1f}MB, int8 = {:.1f}MB ({:.2f}x smaller)".format(float_size/1024**2, quantized_size/1024**2, float_size/quantized_size))
+
+    # Accuracy & latency of both models on the same episodes and splits
+    accuracies = {"float": [], "int8": []}
+    latencies = {"float": 0.0, "int8": 0.0}
+    for ep, episode in enumerate(test_episodes):
+        data, data_labels = load_episode(test_dataset, episode)
+        support_index, query_index = stack_splits([test_splits[ep]], class_num*(sample_num+QUERY_NUM))
+        for name, model in [("float", pipeline), ("int8", quantized)]:
+            start = time.time()
+            accuracies[name].append(episode_accuracy(model, data, data_labels, support_index, query_index))
+            latencies[name] += time.time() - start
+        print("Test_Epi[{}] Float_Accu = {} Int8_Accu = {}".format(ep, accuracies["float"][-1], accuracies["int8"][-1]))
+
+    float_accuracy, quantized_accuracy = np.mean(accuracies["float"]), np.mean(accuracies["int8"])
+    print("Float_Accu = {:.4f}, Int8_Accu = {:.4f}, Delta = {:+.4f}".format(float_accuracy, quantized_accuracy, quantized_accuracy - float_accuracy))
+    print("Episode latency float = {:.3f}s, int8 = {:.3f}s".format(latencies["float"]/args.test_ep, latencies["int8"]/args.test_ep))
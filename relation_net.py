@@ -20,7 +20,7 @@ def weights_init(m):
 
 # Relation Network Module
 class RelationNetwork(nn.Module):
-    def __init__(self, input_size, hidden_size):
+    def __init__(self, input_size, hidden_size, feature_dim=64):
         super(RelationNetwork, self).__init__()
         self.layer1 = nn.Sequential(
                         nn.Conv1d(input_size*2,input_size,kernel_size=1),
@@ -32,7 +32,8 @@ class RelationNetwork(nn.Module):
                         nn.BatchNorm1d(input_size, momentum=1, affine=True),
                         nn.ReLU(),
                         nn.MaxPool1d(2))
-        self.fc1 = nn.Linear(75, hidden_size)
+        # Features are halved by layer1, shortened by 2 and halved again by layer2, 75 for 5 clips of 64 features
+        self.fc1 = nn.Linear(input_size*((feature_dim//2-2)//2), hidden_size)
         self.fc2 = nn.Linear(hidden_size,1)
 
         # # Initialize itself
@@ -40,6 +41,29 @@ class RelationNetwork(nn.Module):
 
     def forward(self,x):    
         out = self.layer1(x)
+        return self.head(out)
+
+    def forward_factorized(self, support, query):
+        '''
+        Same as forward on the support and query concatenated along the clips, without building the pairs.
+        The first 1x1 conv is linear, so it splits into a support half and a query half which are broadcast-added.
+        param:support   shape [query*class*window, class, clip, feature]
+        param:query     shape [query*class*window, clip, feature]
+        return:         shape [query*class*window*class, 1]
+        '''
+        N, C, CL, FE = support.shape # query*class*window, class, clip, feature
+        conv = self.layer1[0]
+        weight = conv.weight[:, :, 0]                                              # [out, clip*2]
+
+        support_out = torch.einsum("oc,nkcf->nkof", weight[:, :CL], support)      # [query*class*window, class, out, feature]
+        query_out = torch.einsum("oc,ncf->nof", weight[:, CL:], query)            # [query*class*window, out, feature]
+        out = support_out + (query_out + conv.bias.view(1, -1, 1)).unsqueeze(1)
+        out = out.reshape(N*C, -1, FE)                                             # [query*class*window*class, out, feature]
+
+        out = self.layer1[1:](out)
+        return self.head(out)
+
+    def head(self, out):
         out = self.layer2(out)
         out = out.view(out.size(0),-1)
         out = nn.functional.relu(self.fc1(out))
@@ -6,11 +6,18 @@ import numpy as np
 import os
 import random
 import argparse
+import json
 
 from relation_net import RelationNetwork as RN
 from encoder import Simple3DEncoder as C3D
 from tcn import TemporalConvNet as TCN
 from attention_pool import AttentionPooling as AP
+from frame_store import FrameStore
+from video_index import load_video_index, index_path
+from fuse import fuse_model
+from pipeline import FewShotPipeline, load_pipeline
+from onnx_backend import OnnxPipeline, ENCODER_NAME
+from embedding_cache import EmbeddingCache, file_hash, checkpoint_hash, fill_cache, cached_embeddings
 import dataset
 from utils import *
 
@@ -22,20 +29,52 @@ parser.add_argument("-s", "--shot", help="number of shots", type=int, default=5)
 parser.add_argument("-g", "--gpu", help="indices of gpu to be used, use all if not specified, e.g. --gpu=2,4,5")
 parser.add_argument("-t", "--test_ep", help="number of test episodes", type=int, default=500)
 parser.add_argument("-p", "--predict", help="whether to use mse or ctc at prediction", choices=["mse", "ctc"], default="ctc")
-parser.add_argument("-c", "--checkpoint", help="path of a checkpoint to start from, a path with its name as the accuracy", required=True)
+parser.add_argument("-c", "--checkpoint", help="path of a checkpoint to start from, a path with its name as the accuracy")
+parser.add_argument("--frame_size", help="height and width of the input frames, e.g. 64 or 96 for a fast mode", type=int, default=128)
+parser.add_argument("--frame_num", help="number of frames per clip", type=int, default=10)
+parser.add_argument("--clip_num", help="number of clips per window", type=int, default=5)
+parser.add_argument("--window_num", help="number of windows per video", type=int, default=3)
+parser.add_argument("--head", help="head between the encoder and the TCN, flatten keeps the original layout of old checkpoints", choices=["flatten", "avg", "bottleneck"], default="flatten")
+parser.add_argument("--frame_store", help="path of a frame store packed by frame_store.py, decode jpgs if not specified")
+parser.add_argument("--rebuild_index", help="whether to rebuild the cached video index next to the dataset json", action="store_true")
+parser.add_argument("--uint8", help="whether to load clips as uint8 and normalize them on the computing device", action="store_true")
+parser.add_argument("--workers", help="number of worker processes preparing episodes", type=int, default=4)
+parser.add_argument("--prefetch", help="number of episodes kept ready by the workers", type=int, default=8)
+parser.add_argument("--split_seed", help="seed of the support & query splits and of the test episodes, random if not specified", type=int)
+parser.add_argument("--episodes", help="number of episodes stacked into one forward pass", type=int, default=1)
+parser.add_argument("--fuse", help="whether to remove weight norms and fold batch norms into the layers before testing", action="store_true")
+parser.add_argument("--pipeline", help="path of a pipeline exported by pipeline.py, run instead of the models of a checkpoint")
+parser.add_argument("--onnx", help="folder of the graphs exported by onnx_backend.py, run on the CPU by onnxruntime instead of the models of a checkpoint")
+parser.add_argument("--compile", help="whether to run the pipeline through torch.compile", action="store_true")
+parser.add_argument("--bf16", help="whether to run the models under bfloat16 autocast, the probabilities stay in float32", action="store_true")
+parser.add_argument("--channels_last", help="whether to run C3D in the channels_last_3d memory format, faster for the oneDNN 3-D convolutions on CPU", action="store_true")
+parser.add_argument("--cache", help="whether to encode every test video once and reuse its embedding in all episodes", action="store_true")
+parser.add_argument("--cache_dir", help="folder of the on-disk embedding cache, shared by runs on the same checkpoint, memory only if not specified")
+parser.add_argument("--cache_size", help="number of embeddings kept in memory by the cache", type=int, default=100000)
+parser.add_argument("--split_schedule", help="path of a saved split schedule, replayed if it exists, otherwise generated and saved there")
 
 args = parser.parse_args()
 
-if not os.exists(args.dataset):
+if not os.path.exists(args.dataset):
     raise Exception("invalid dataset path: {}".format(args.dataset))
 else:
     file = open(args.dataset, 'r')
     text = file.readline()
     file.close()
     dataset_info = json.loads(text)
+if args.workers < 0 or args.prefetch <= 0:
+    raise Exception("workers must be non-negative and prefetch must be positive")
+if args.episodes <= 0:
+    raise Exception("episodes per pass must be positive")
+if args.cache_size <= 0:
+    raise Exception("cache size must be positive")
+if args.frame_size <= 0 or args.frame_num <= 0 or args.clip_num <= 0 or args.window_num <= 0:
+    raise Exception("frame size, frames, clips and windows must be positive")
+if args.clip_num * args.window_num < 2:
+    raise Exception("a video needs at least two clips")
 if args.gpu is not None:
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
-device = torch.device('cuda')
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 if args.way > 1:
     CLASS_NUM = args.way
 else:
@@ -44,131 +83,189 @@ if args.shot >= 1:
     SAMPLE_NUM = args.shot
 else:
     raise Exception("zero-shot is beyond the scope of this project")
-if not os.path.exists(args.checkpoint):
+if args.pipeline is None and args.onnx is None and (args.checkpoint is None or not os.path.exists(args.checkpoint)):
     raise Exception("invalid checkpoint path: {}".format(args.checkpoint))
+if args.pipeline is not None and not os.path.exists(args.pipeline):
+    raise Exception("invalid pipeline path: {}".format(args.pipeline))
+if args.onnx is not None and not os.path.exists(args.onnx):
+    raise Exception("invalid onnx path: {}".format(args.onnx))
+if args.pipeline is not None and args.onnx is not None:
+    raise Exception("choose either an exported pipeline or onnx graphs")
+if args.pipeline is not None and args.cache:
+    raise Exception("an exported pipeline takes clips, it cannot read cached embeddings")
+if args.onnx is not None and args.compile:
+    raise Exception("onnx graphs are optimized by onnxruntime, they cannot be compiled")
+if (args.pipeline is not None or args.onnx is not None) and args.bf16:
+    raise Exception("exported pipelines and onnx graphs run in the precision they were exported with, bf16 autocast only applies to checkpoints")
+if (args.pipeline is not None or args.onnx is not None) and args.channels_last:
+    raise Exception("exported pipelines and onnx graphs keep the memory format they were exported with, channels_last only applies to checkpoints")
+if args.frame_store is not None and not os.path.exists(args.frame_store):
+    raise Exception("invalid frame store path: {}".format(args.frame_store))
+frame_store = FrameStore(args.frame_store) if args.frame_store is not None else None
+video_index = load_video_index(index_path(args.dataset), dataset_info, rebuild=args.rebuild_index)
 
 # Some Constants
-CLIP_NUM = 5    # Num of clips per window
-WINDOW_NUM = 3  # Num of processing window per video
-FRAME_NUM = 10  # Num of frames per clip
+CLIP_NUM = args.clip_num      # Num of clips per window
+WINDOW_NUM = args.window_num  # Num of processing window per video
+FRAME_NUM = args.frame_num    # Num of frames per clip
+FRAME_SIZE = args.frame_size  # Height and width of frames
 QUERY_NUM = 5   # Num of instances for query per class
-INST_NUM = 10   # Num of videos selected in each class (A silly design, will be removed later)
+EPISODE_NUM = args.episodes   # Num of episodes per forward pass
 TCN_OUT = 64    # Num of channels of output of TCN
 
-# Define models
-c3d = C3D(in_channels=3) 
-c3d = nn.DataParallel(c3d)
-tcn = TCN(245760, [128,128,64,TCN_OUT])
-ap = AP(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, TCN_OUT)
-rn = RN(CLIP_NUM, hidden_size=32) 
-
-# Move models to GPU
-c3d.to(device)
-rn.to(device)
-tcn.to(device)
-ap.to(device)
-
-# Load Saved Models & Optimizers & Schedulers
-my_load(c3d, "c3d.pkl")
-my_load(tcn, "tcn.pkl")
-my_load(ap, "ap.pkl")
-my_load(rn, "rn.pkl")
+if args.pipeline is None and args.onnx is None:
+    # Define models
+    c3d = C3D(in_channels=3, head=args.head, frame_num=FRAME_NUM, frame_size=FRAME_SIZE, channels_last=args.channels_last)
+    tcn = TCN(c3d.output_dim, [128,128,64,TCN_OUT])
+    c3d = nn.DataParallel(c3d)
+    ap = AP(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, TCN_OUT)
+    rn = RN(CLIP_NUM, hidden_size=32, feature_dim=TCN_OUT)
+
+    # Move models to GPU
+    c3d.to(device)
+    rn.to(device)
+    tcn.to(device)
+    ap.to(device)
+
+    # Load Saved Models & Optimizers & Schedulers
+    my_load(c3d, "c3d.pkl", args.checkpoint, device)
+    my_load(tcn, "tcn.pkl", args.checkpoint, device)
+    my_load(ap, "ap.pkl", args.checkpoint, device)
+    my_load(rn, "rn.pkl", args.checkpoint, device)
+
+    # Inference Graph
+    if args.fuse:
+        c3d = fuse_model(c3d)
+        tcn = fuse_model(tcn)
+        ap = fuse_model(ap)
+        rn = fuse_model(rn)
+
+    # Encoding, pooling and relation of test.py, scored by cosine similarity
+    # Batch norms use their running statistics, so that a query does not depend on the other episodes of its --episodes batch
+    pipeline = FewShotPipeline(c3d, tcn, ap, rn, CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, FRAME_NUM, FRAME_SIZE, relation="cos").eval()
+elif args.onnx is not None:
+    # ONNX Runtime backend on the CPU, the episode and query axes of its graphs are dynamic
+    pipeline = OnnxPipeline(args.onnx)
+    expected = {"way": CLASS_NUM, "shot": SAMPLE_NUM, "query": QUERY_NUM, "frame_size": FRAME_SIZE, "frame_num": FRAME_NUM,
+                "clip_num": CLIP_NUM, "window_num": WINDOW_NUM}
+    for key, value in expected.items():
+        if pipeline.config[key] != value:
+            raise Exception("onnx graphs {} were exported with {} = {}, not {}".format(args.onnx, key, pipeline.config[key], value))
+else:
+    # Traced pipeline, specialized to the way, shot, clip shape and episodes it was exported with
+    pipeline, pipeline_config = load_pipeline(args.pipeline, device)
+    expected = {"way": CLASS_NUM, "shot": SAMPLE_NUM, "query": QUERY_NUM, "frame_size": FRAME_SIZE, "frame_num": FRAME_NUM,
+                "clip_num": CLIP_NUM, "window_num": WINDOW_NUM, "uint8": args.uint8}
+    for key, value in expected.items():
+        if pipeline_config[key] != value:
+            raise Exception("pipeline {} was exported with {} = {}, not {}".format(args.pipeline, key, pipeline_config[key], value))
+    EPISODE_NUM = pipeline_config["episodes"]
+    if args.test_ep % EPISODE_NUM != 0:
+        raise Exception("test episodes must be a multiple of the {} episodes of the pipeline".format(EPISODE_NUM))
+if args.compile:
+    if args.cache:
+        # The cache calls encode and relate directly, torch.compile(pipeline) would only compile forward
+        pipeline.encode = torch.compile(pipeline.encode)
+        pipeline.relate = torch.compile(pipeline.relate)
+    else:
+        pipeline = torch.compile(pipeline)
+
+# Mixed Precision
+def autocast():
+    # Models in bfloat16 with --bf16, FewShotPipeline casts the relations back to float32 before the softmax
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16)
+
+# Encoding
+def encode(data):
+    # [video, window*clip, RGB, frame, H, W] -> [video, window*clip, feature]
+    return pipeline.encode(data.to(device, non_blocking=True))
+
+# Support & Query Splits
+if args.split_schedule is not None and os.path.exists(args.split_schedule):
+    split_schedule = EpisodeSplitSchedule.load(args.split_schedule)
+    if split_schedule.class_num != CLASS_NUM or split_schedule.support_num != SAMPLE_NUM or split_schedule.query_num != QUERY_NUM:
+        raise Exception("split schedule {} does not match {}-way {}-shot".format(args.split_schedule, CLASS_NUM, SAMPLE_NUM))
+else:
+    split_schedule = EpisodeSplitSchedule(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, args.test_ep, args.split_seed, repeat=True)
+    if args.split_schedule is not None:
+        split_schedule.save(args.split_schedule)
+test_splits = iter(split_schedule)
+
+# The episodes are seeded from the splits, as the validation episodes of train.py, so that a replayed schedule also replays its videos
+# (schedules saved without a seed draw random episodes)
+episode_seed = None if split_schedule.seed is None else split_schedule.seed + 1
+
+# Episode Loader
+test_dataset = dataset.get_video_dataset(dataset_info, "test", video_index, FRAME_NUM, CLIP_NUM, WINDOW_NUM, SAMPLE_NUM+QUERY_NUM, frame_store, not args.uint8, FRAME_SIZE)
+if not args.cache:
+    test_episodes = iter(dataset.get_episode_loader(test_dataset, CLASS_NUM, SAMPLE_NUM+QUERY_NUM, args.workers, args.prefetch, seed=episode_seed))
+else:
+    # Draw all episodes first and encode each of their videos once, episodes then only read embeddings
+    cache_params = [FRAME_SIZE, FRAME_NUM, CLIP_NUM, WINDOW_NUM, args.head, TCN_OUT] + (["bf16"] if args.bf16 else [])
+    if args.onnx is None:
+        cache = EmbeddingCache(checkpoint_hash(args.checkpoint), cache_params, args.cache_size, args.cache_dir)
+    else:
+        cache = EmbeddingCache(file_hash([os.path.join(args.onnx, ENCODER_NAME)]), cache_params, args.cache_size, args.cache_dir)
+
+    sampler = iter(dataset.EpisodicBatchSampler(test_dataset.video_labels, CLASS_NUM, SAMPLE_NUM+QUERY_NUM, episode_seed))
+    test_episodes = [next(sampler) for _ in range(args.test_ep)]
+    with torch.no_grad(), autocast():
+        encoded = fill_cache(cache, test_dataset, [idx for episode in test_episodes for idx in episode], encode, CLASS_NUM*(SAMPLE_NUM+QUERY_NUM), args.workers)
+    print("Encoded {} videos, {} embeddings in memory".format(encoded, len(cache)))
+    test_episodes = iter(test_episodes)
 
 # Testing
-with torch.no_grad():
+with torch.no_grad(), autocast():
     accuracies = []
 
     test_ep = 0
     while test_ep < args.test_ep:
-        
-        # Data Loading
-        try:
-            if dataset_info["name"] != "finegym":
-                the_dataset = dataset.StandardDataset(dataset_info["folders"], "test", dataset_info["split"], CLASS_NUM, INST_NUM, FRAME_NUM, CLIP_NUM, WINDOW_NUM)
-            else:
-                the_dataset = dataset.FinegymDataset(dataset_info["folder"], dataset_info["finegym_info"], "test", dataset_info["split"], CLASS_NUM, INST_NUM, FRAME_NUM, CLIP_NUM, WINDOW_NUM)
-            dataloader = dataset.get_data_loader(the_dataset, num_per_class=SAMPLE_NUM+QUERY_NUM, num_workers=0)
-            data, data_labels = dataloader.__iter__().next()     # [class*(support+query), window*clip, RGB, frame, H, W]
-        except Exception:
-            continue
-        data = data.view(-1, 3, FRAME_NUM, 128, 128)
-
-        print("Test_Epi[{}]".format(test_ep), end="\t")
+        episode_num = min(EPISODE_NUM, args.test_ep - test_ep)
 
         # Generate support & query split
-        query_index = []
-        support_index = []
-        for i in range(CLASS_NUM):
-            start = (SAMPLE_NUM+QUERY_NUM) * i
-            end = (SAMPLE_NUM+QUERY_NUM) * (i+1)
-            index = list(range(start, end))
-            q = random.sample(index, QUERY_NUM)
-            s = list(set(index)-set(q))
-            query_index.extend(q)
-            support_index.extend(s)
-        random.shuffle(query_index)
-        query_index = torch.tensor(query_index)
-        support_index = torch.tensor(support_index)
-        
-        # Encoding
-        embed = c3d(Variable(data).to(device))
-        embed = embed.view(CLASS_NUM*(SAMPLE_NUM+QUERY_NUM), WINDOW_NUM*CLIP_NUM, -1)  # [class*(support+query), window*clip, feature]
-
-        # TCN Processing
-        embed = torch.transpose(embed, 1, 2)           # [class*(support+query), feature(channel), window*clip(length)]
-        embed = tcn(embed)
-        embed = torch.transpose(embed, 1, 2)           # [class*(support+query), window*clip, feature]
-
-        # Split data into support & query
-        samples = embed[support_index] # [class*support, window*clip, feature]
-        batches = embed[query_index]   # [class*query, window*clip, feature]
+        support_index, query_index = stack_splits([next(test_splits) for _ in range(episode_num)], CLASS_NUM*(SAMPLE_NUM+QUERY_NUM))
+
+        # Data Loading, episodes are stacked one after another
+        episodes = [next(test_episodes) for _ in range(episode_num)]
+        if not args.cache:
+            data = torch.cat([data for data, _ in episodes])                        # [episode*class*(support+query), window*clip, RGB, frame, H, W]
+            data_labels = torch.cat([data_labels for _, data_labels in episodes])
+        else:
+            embed = cached_embeddings(cache, test_dataset, [idx for episode in episodes for idx in episode], encode).to(device, non_blocking=True)
+            data_labels = torch.cat([dataset.episode_labels(torch.tensor([test_dataset.video_labels[idx] for idx in episode])) for episode in episodes])
         batches_labels = data_labels[query_index]
 
-        # Attention Pooling
-        samples = samples.reshape(CLASS_NUM*SAMPLE_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [class*sample*window, clip, feature]
-        batches = batches.reshape(CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [query*class*window, clip, feature]
-        samples = ap(samples, batches)                    # [query*class*window, class, clip, feature]
-
-        # Compute Relation
-        batches_rn = batches.unsqueeze(0).repeat(CLASS_NUM,1,1,1)  # [class, query*class*window, clip, feature]
-        batches_rn = torch.transpose(batches_rn,0,1)               # [query*class*window, class, clip, feature]
-        relations = torch.cat((samples,batches_rn),2).reshape(-1,CLIP_NUM*2,TCN_OUT)    # [query*class*window, class, clip*2(channel), feature]
-        relations = rn(relations).reshape(QUERY_NUM*CLASS_NUM, WINDOW_NUM, CLASS_NUM)    # [query*class, window, class]
-        relations_ctc = torch.cat((blank_prob, relations), 2)             # [query*class, window(length), class+1]
-        final_outcome = torch.transpose(logSoftmax(relations_ctc), 0, 1)  # [window(length), query*class, class+1]
-        
-        cos = nn.CosineSimilarity(dim=2)
-        samples = samples.reshape(CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLASS_NUM, -1)
-        batches = batches.reshape(CLASS_NUM*QUERY_NUM*WINDOW_NUM,1,-1).repeat(1,CLASS_NUM,1)
-        relations = cos(samples,batches).reshape(QUERY_NUM*CLASS_NUM, WINDOW_NUM, CLASS_NUM)
-        
-        # Generate final probabilities
-        blank_prob = torch.full(size=(QUERY_NUM*CLASS_NUM, WINDOW_NUM, 1), fill_value=1, dtype=torch.float).to(device)
-        relations_ctc = torch.cat((blank_prob, relations), 2)
-        final_outcome = nn.functional.softmax(relations_ctc, 2)  # [query*class, window(length), class+1]
+        print("Test_Epi[{}]".format(test_ep), end="\t")
+
+        # Encoding, Attention Pooling & Relation
+        if not args.cache:
+            relations, final_outcome = pipeline(data.to(device, non_blocking=True), support_index.to(device), query_index.to(device))
+        else:
+            relations, final_outcome = pipeline.relate(embed, support_index.to(device), query_index.to(device))
+        # relations [episode*query*class, window, class], final_outcome [episode*query*class, window(length), class+1]
 
         # Predict
         batches_labels = batches_labels.numpy()
         if args.predict == "mse":
-            relations_mse = nn.functional.softmax(torch.sum(relations, 1), dim=1) # [query*class, class]
+            relations_mse = nn.functional.softmax(torch.sum(relations, 1), dim=1) # [episode*query*class, class]
             _, predict_labels = torch.max(relations_mse.data, 1)
             batches_labels = batches_labels - 1
         else:
-            predict_labels = ctc_predict(final_outcome.cpu().numpy())
             predict_labels = ctc_predict_single(final_outcome)
 
         rewards = [1 if predict_labels[i] == batches_labels[i] else 0 for i in range(len(predict_labels))]
-        total_rewards = np.sum(rewards)
 
-        # Record accuracy
-        accuracy = total_rewards/(CLASS_NUM * QUERY_NUM)
-        accuracies.append(accuracy)
-        print("Accuracy = {}".format(accuracy), end='\t')
+        # Record accuracy of every episode
+        episode_accuracies = np.mean(np.reshape(rewards, (episode_num, CLASS_NUM * QUERY_NUM)), 1)
+        accuracies.extend(episode_accuracies.tolist())
+        print("Accuracy = {}".format(episode_accuracies[0] if episode_num == 1 else episode_accuracies.tolist()), end='\t')
         test_accuracy, _ = mean_confidence_interval(accuracies)
         print("Average Accuracy = {}".format(test_accuracy))
 
-        test_ep += 1
+        test_ep += episode_num
 
 # Average accuracy
 test_accuracy, _ = mean_confidence_interval(accuracies)
-print("Final_Accu = {}".format(test_accuracy))
\ No newline at end of file
+print("Final_Accu = {}".format(test_accuracy))
+if args.cache:
+    print("Embedding cache hits = {}, misses = {}".format(cache.hits, cache.misses))
\ No newline at end of file
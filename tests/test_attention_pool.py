@@ -0,0 +1,58 @@
+# Efficient, chunked and per-episode attention pooling against the copying and per-episode reference paths
+import copy
+
+import pytest
+import torch
+
+from attention_pool import AttentionPooling, AttentionPoolingConv
+
+CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, FEATURE_DIM = 3, 2, 2, 3, 5, 8
+
+def make_pooling(pooling, **kwargs):
+    torch.manual_seed(0)
+    return pooling(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, FEATURE_DIM, **kwargs).double()
+
+def random_episodes(episode_num, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    samples = torch.randn(episode_num, CLASS_NUM*SAMPLE_NUM*WINDOW_NUM, CLIP_NUM, FEATURE_DIM, generator=generator, dtype=torch.float64)
+    batches = torch.randn(episode_num, CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, FEATURE_DIM, generator=generator, dtype=torch.float64)
+    return samples, batches
+
+def warm_up(model):
+    # Non-trivial running statistics for eval mode
+    model.train()
+    with torch.no_grad():
+        samples, batches = random_episodes(1, seed=1)
+        model(samples[0], batches[0])
+    return model.eval()
+
+@pytest.mark.parametrize("pooling", [AttentionPooling, AttentionPoolingConv])
+@pytest.mark.parametrize("training", [True, False])
+def test_efficient_matches_copying(pooling, training):
+    efficient = warm_up(make_pooling(pooling)).train(training)
+    reference = copy.deepcopy(efficient)
+    reference.efficient = False
+    samples, batches = random_episodes(1)
+
+    with torch.no_grad():
+        assert torch.allclose(efficient(samples[0], batches[0]), reference(samples[0], batches[0]), rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize("pooling", [AttentionPooling, AttentionPoolingConv])
+def test_chunked_matches_whole(pooling):
+    whole = warm_up(make_pooling(pooling))
+    chunked = copy.deepcopy(whole)
+    chunked.chunk_size = 4
+    samples, batches = random_episodes(1)
+
+    with torch.no_grad():
+        assert torch.allclose(chunked(samples[0], batches[0]), whole(samples[0], batches[0]), rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize("pooling", [AttentionPooling, AttentionPoolingConv])
+def test_episodes_match_per_episode(pooling):
+    model = warm_up(make_pooling(pooling))
+    samples, batches = random_episodes(3)
+
+    with torch.no_grad():
+        expected = torch.stack([model(samples[e], batches[e]) for e in range(3)])
+        assert torch.allclose(model.forward_episodes(samples, batches), expected, rtol=0, atol=1e-12)
+        assert torch.allclose(model.pool_episodes(samples[:1], batches[:1]), expected[:1], rtol=0, atol=1e-12)
@@ -0,0 +1,55 @@
+# Batched CTC scorers against the recursive forward algorithm of ctc/ctc_loss.py
+import torch
+
+from ctc.ctc_batch import ctc_log_likelihood, ctc_single_label_log_likelihood, pad_targets
+from ctc.ctc_loss import ctcLabelingProb
+from utils import ctc_alignment_predict, ctc_predict_single
+
+def random_probs(generator, N, T, C):
+    probs = torch.rand(N, T, C, generator=generator, dtype=torch.float64) + 1e-3
+    return probs / probs.sum(2, keepdim=True)
+
+def reference_prob(prob, truth):
+    # ctc_loss puts the blank last and reads labels as symbols of <classes>, here blank is 0 and labels start at 1
+    classes = [str(c) for c in range(1, int(prob.shape[1]))]
+    mat = torch.cat((prob[:, 1:], prob[:, :1]), 1).numpy()
+    return ctcLabelingProb(mat, [str(int(label)) for label in truth], classes)
+
+def test_log_likelihood_matches_recursive():
+    generator = torch.Generator().manual_seed(0)
+    probs = random_probs(generator, 4, 6, 5)
+    truths = [[1], [2, 2], [3, 1, 3], [4, 2, 1, 2], [1, 1, 1]]
+    targets, target_lengths = pad_targets([label for truth in truths for label in truth], [len(truth) for truth in truths])
+
+    likelihood = ctc_log_likelihood(torch.log(probs), targets, target_lengths).exp()
+    for n in range(probs.shape[0]):
+        for s, truth in enumerate(truths):
+            assert abs(float(likelihood[n, s]) - reference_prob(probs[n], truth)) < 1e-10
+
+def test_single_label_matches_recursive():
+    generator = torch.Generator().manual_seed(1)
+    probs = random_probs(generator, 8, 5, 6)
+    labels = torch.arange(1, 6)
+
+    likelihood = ctc_single_label_log_likelihood(torch.log(probs), labels).exp()
+    general = ctc_log_likelihood(torch.log(probs), labels.view(-1, 1), torch.ones(5, dtype=torch.long)).exp()
+    for n in range(probs.shape[0]):
+        for s, label in enumerate(labels):
+            assert abs(float(likelihood[n, s]) - reference_prob(probs[n], [label])) < 1e-10
+    assert torch.allclose(likelihood, general, rtol=0, atol=1e-12)
+
+def test_predict_single_matches_per_class_loop():
+    generator = torch.Generator().manual_seed(2)
+    probs = random_probs(generator, 20, 3, 4)
+
+    expected = [max(range(1, 4), key=lambda c: reference_prob(prob, [c])) for prob in probs]
+    assert ctc_predict_single(probs).tolist() == expected
+
+def test_alignment_predict_matches_per_target_loop():
+    generator = torch.Generator().manual_seed(3)
+    probs = random_probs(generator, 10, 6, 4)
+    truths = [[1, 2], [1], [2, 3, 2], [3, 3], [2], [1, 3]]   # 3 classes of 2 samples
+    targets, target_lengths = [label for truth in truths for label in truth], [len(truth) for truth in truths]
+
+    expected = [max(range(len(truths)), key=lambda s: reference_prob(prob, truths[s])) // 2 + 1 for prob in probs]
+    assert ctc_alignment_predict(probs, torch.tensor(targets), torch.tensor(target_lengths), 2) == expected
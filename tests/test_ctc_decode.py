@@ -0,0 +1,17 @@
+# Batched prefix beam search against the per-item decoder
+import numpy as np
+import pytest
+
+from ctc.ctc_decode import decode, decode_batch
+
+@pytest.mark.parametrize("beam_size", [2, 5, 100])
+def test_decode_batch_matches_decode(beam_size):
+    rng = np.random.RandomState(beam_size)
+    for T, S in [(1, 3), (3, 4), (6, 4), (5, 7)]:
+        probs = rng.rand(50, T, S) + 1e-3
+        probs /= probs.sum(2, keepdims=True)
+
+        for (labels, score), prob in zip(decode_batch(probs, beam_size), probs):
+            expected_labels, expected_score = decode(prob, beam_size)
+            assert labels == expected_labels
+            assert abs(score - expected_score) < 1e-9
@@ -0,0 +1,44 @@
+# Fused inference models against the models they are fused from, in eval mode
+import pytest
+import torch
+
+from fuse import fuse_model
+from pipeline import FewShotPipeline, build_pipeline_models
+from utils import episode_splits, stack_splits
+
+CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, FRAME_NUM, FRAME_SIZE = 3, 2, 1, 3, 5, 4, 32
+EPISODE_SIZE = CLASS_NUM*(SAMPLE_NUM + QUERY_NUM)
+
+def random_episodes(episode_num, generator):
+    data = torch.randint(0, 256, (episode_num*EPISODE_SIZE, WINDOW_NUM*CLIP_NUM, 3, FRAME_NUM, FRAME_SIZE, FRAME_SIZE), generator=generator, dtype=torch.uint8)
+    splits = [episode_splits(1, CLASS_NUM, SAMPLE_NUM, QUERY_NUM, generator) for _ in range(episode_num)]
+    support_index, query_index = stack_splits([(s[0], q[0]) for s, q in splits], EPISODE_SIZE)
+    return data, support_index, query_index
+
+@pytest.mark.parametrize("relation", ["rn", "cos"])
+def test_fused_matches_eval(relation):
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    models = build_pipeline_models(CLASS_NUM, SAMPLE_NUM, WINDOW_NUM, CLIP_NUM, FRAME_NUM, FRAME_SIZE)
+    pipeline = FewShotPipeline(*models, CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, FRAME_NUM, FRAME_SIZE, relation)
+
+    # Non-trivial running statistics and weight norms, as after training
+    with torch.no_grad():
+        for _ in range(2):
+            pipeline(*random_episodes(1, generator))
+    pipeline.eval()
+    state = {k: v.clone() for k, v in pipeline.state_dict().items()}
+
+    fused = FewShotPipeline(*[fuse_model(model) for model in models], CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, FRAME_NUM, FRAME_SIZE, relation)
+    episodes = random_episodes(2, generator)
+    with torch.no_grad():
+        relations, probs = pipeline(*episodes)
+        fused_relations, fused_probs = fused(*episodes)
+
+    assert torch.allclose(fused_relations, relations, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(fused_probs, probs, rtol=1e-4, atol=1e-5)
+
+    # The models fused from are left unchanged
+    assert all(torch.equal(v, state[k]) for k, v in pipeline.state_dict().items())
+    with pytest.raises(Exception):
+        fused.c3d.train()
@@ -0,0 +1,18 @@
+# Factorized relation scores against the relation network on concatenated support and query pairs
+import pytest
+import torch
+
+from relation_net import RelationNetwork
+
+@pytest.mark.parametrize("training", [True, False])
+def test_factorized_matches_pairs(training):
+    N, C, CL, FE = 6, 3, 5, 64
+    torch.manual_seed(0)
+    rn = RelationNetwork(CL, hidden_size=32, feature_dim=FE).double().train(training)
+    generator = torch.Generator().manual_seed(1)
+    support = torch.randn(N, C, CL, FE, generator=generator, dtype=torch.float64)
+    query = torch.randn(N, CL, FE, generator=generator, dtype=torch.float64)
+
+    pairs = torch.cat((support, query.unsqueeze(1).expand(N, C, CL, FE)), 2).reshape(N*C, 2*CL, FE)
+    with torch.no_grad():
+        assert torch.allclose(rn.forward_factorized(support, query), rn(pairs), rtol=0, atol=1e-12)
@@ -13,6 +13,9 @@ from relation_net import RelationNetwork as RN
 from encoder import Simple3DEncoder as C3D
 from tcn import TemporalConvNet as TCN
 from attention_pool import AttentionPooling as AP
+from frame_store import FrameStore
+from video_index import load_video_index, index_path
+from embedding_cache import checkpoint_hash, load_features
 import dataset
 from utils import *
 
@@ -31,10 +34,26 @@ parser.add_argument("--load_frq", help="loading frequency, one means load new da
 parser.add_argument("-m", "--mse_also", help="whether to use mse together with ctc loss", action="store_true")
 parser.add_argument("-p", "--predict", help="whether to use mse or ctc at prediction", choices=["mse", "ctc"], default="ctc")
 parser.add_argument("-c", "--checkpoint", help="path of a checkpoint to start from, a path with its name as the accuracy")
+parser.add_argument("--frame_size", help="height and width of the input frames, e.g. 64 or 96 for a fast mode", type=int, default=128)
+parser.add_argument("--frame_num", help="number of frames per clip", type=int, default=10)
+parser.add_argument("--clip_num", help="number of clips per window", type=int, default=5)
+parser.add_argument("--window_num", help="number of windows per video", type=int, default=3)
+parser.add_argument("--head", help="head between the encoder and the TCN, flatten keeps the original layout of old checkpoints", choices=["flatten", "avg", "bottleneck"], default="flatten")
+parser.add_argument("--frame_store", help="path of a frame store packed by frame_store.py, decode jpgs if not specified")
+parser.add_argument("--rebuild_index", help="whether to rebuild the cached video index next to the dataset json", action="store_true")
+parser.add_argument("--uint8", help="whether to load clips as uint8 and normalize them on the computing device", action="store_true")
+parser.add_argument("--workers", help="number of worker processes preparing episodes", type=int, default=4)
+parser.add_argument("--prefetch", help="number of episodes kept ready by the workers", type=int, default=8)
+parser.add_argument("--episodes", help="number of episodes stacked into one forward pass and one update", type=int, default=1)
+parser.add_argument("--frozen", help="whether to freeze C3D and TCN and train only the attention pooling and relation network on features extracted once", action="store_true")
+parser.add_argument("--feature_store", help="folder to keep the extracted features of --frozen in, extracted again every run if not specified")
+parser.add_argument("--split_seed", help="seed of the support & query splits and of the validation episodes, random if not specified", type=int)
+parser.add_argument("--bf16", help="whether to run the forward passes of the models under bfloat16 autocast, the softmax and the losses stay in float32", action="store_true")
+parser.add_argument("--channels_last", help="whether to run C3D in the channels_last_3d memory format, faster for the oneDNN 3-D convolutions on CPU", action="store_true")
 
 args = parser.parse_args()
 
-if not os.exists(args.dataset):
+if not os.path.exists(args.dataset):
     raise Exception("invalid dataset path: {}".format(args.dataset))
 else:
     file = open(args.dataset, 'r')
@@ -45,9 +64,15 @@ if args.load_frq <= 0:
     raise Exception("loading frequency must be positive")
 if args.train_ep <= 0 or args.valid_ep <= 0:
     raise Exception("training and validation episodes must be positive")
+if args.workers < 0 or args.prefetch <= 0:
+    raise Exception("workers must be non-negative and prefetch must be positive")
+if args.frame_size <= 0 or args.frame_num <= 0 or args.clip_num <= 0 or args.window_num <= 0:
+    raise Exception("frame size, frames, clips and windows must be positive")
+if args.clip_num * args.window_num < 2:
+    raise Exception("a video needs at least two clips")
 if args.gpu is not None:
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
-device = torch.device('cuda')
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 if args.way > 1:
     CLASS_NUM = args.way
 else:
@@ -58,22 +83,33 @@ else:
     raise Exception("zero-shot is beyond the scope of this project")
 if args.checkpoint is not None and not os.path.exists(args.checkpoint):
     raise Exception("invalid checkpoint path: {}".format(args.checkpoint))
+if args.episodes <= 0:
+    raise Exception("episodes per pass must be positive")
+if args.frozen and args.checkpoint is None:
+    raise Exception("a frozen backbone needs a checkpoint with c3d.pkl and tcn.pkl")
+if args.feature_store is not None and not os.path.exists(args.feature_store):
+    os.makedirs(args.feature_store)
+if args.frame_store is not None and not os.path.exists(args.frame_store):
+    raise Exception("invalid frame store path: {}".format(args.frame_store))
+frame_store = FrameStore(args.frame_store) if args.frame_store is not None else None
+video_index = load_video_index(index_path(args.dataset), dataset_info, rebuild=args.rebuild_index)
 
 # Some Constants
-CLIP_NUM = 5    # Num of clips per window
-WINDOW_NUM = 3  # Num of processing window per video
-FRAME_NUM = 10  # Num of frames per clip
+CLIP_NUM = args.clip_num      # Num of clips per window
+WINDOW_NUM = args.window_num  # Num of processing window per video
+FRAME_NUM = args.frame_num    # Num of frames per clip
+FRAME_SIZE = args.frame_size  # Height and width of frames
 QUERY_NUM = 5   # Num of instances for query per class
-INST_NUM = 10   # Num of videos selected in each class (A silly design, will be removed later)
+EPISODE_NUM = args.episodes   # Num of episodes per forward pass
 TCN_OUT = 64    # Num of channels of output of TCN
 max_accuracy = 0
 
 # Define Models
-c3d = C3D(in_channels=3) 
+c3d = C3D(in_channels=3, head=args.head, frame_num=FRAME_NUM, frame_size=FRAME_SIZE, channels_last=args.channels_last)
+tcn = TCN(c3d.output_dim, [128,128,64,TCN_OUT])
 c3d = nn.DataParallel(c3d)
-tcn = TCN(245760, [128,128,64,TCN_OUT])
 ap = AP(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, WINDOW_NUM, CLIP_NUM, TCN_OUT)
-rn = RN(CLIP_NUM, hidden_size=32) 
+rn = RN(CLIP_NUM, hidden_size=32, feature_dim=TCN_OUT)
 
 ctc = nn.CTCLoss()
 logSoftmax = nn.LogSoftmax(2)
@@ -103,18 +139,18 @@ ap_scheduler = StepLR(ap_optim, step_size=3000, gamma=0.5)
 
 # Load Saved Models & Optimizers & Schedulers
 if args.checkpoint is not None:
-    my_load(c3d, "c3d.pkl")
-    my_load(tcn, "tcn.pkl")
-    my_load(ap, "ap.pkl")
-    my_load(rn, "rn.pkl")
-    my_load(c3d_optim, "c3d_optim.pkl")
-    my_load(tcn_optim, "tcn_optim.pkl")
-    my_load(ap_optim, "ap_optim.pkl")
-    my_load(rn_optim, "rn_optim.pkl")
-    my_load(c3d_scheduler, "c3d_scheduler.pkl")
-    my_load(tcn_scheduler, "tcn_scheduler.pkl")
-    my_load(ap_scheduler, "ap_scheduler.pkl")
-    my_load(rn_scheduler, "rn_scheduler.pkl")
+    my_load(c3d, "c3d.pkl", args.checkpoint, device)
+    my_load(tcn, "tcn.pkl", args.checkpoint, device)
+    my_load(ap, "ap.pkl", args.checkpoint, device)
+    my_load(rn, "rn.pkl", args.checkpoint, device)
+    my_load(c3d_optim, "c3d_optim.pkl", args.checkpoint, device)
+    my_load(tcn_optim, "tcn_optim.pkl", args.checkpoint, device)
+    my_load(ap_optim, "ap_optim.pkl", args.checkpoint, device)
+    my_load(rn_optim, "rn_optim.pkl", args.checkpoint, device)
+    my_load(c3d_scheduler, "c3d_scheduler.pkl", args.checkpoint, device)
+    my_load(tcn_scheduler, "tcn_scheduler.pkl", args.checkpoint, device)
+    my_load(ap_scheduler, "ap_scheduler.pkl", args.checkpoint, device)
+    my_load(rn_scheduler, "rn_scheduler.pkl", args.checkpoint, device)
 
     tmp = os.path.split(args.checkpoint)[1]
     if "Latest_" in tmp:
@@ -127,74 +163,110 @@ if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
 # Some Constant Tensors
-input_lengths = torch.full(size=(QUERY_NUM*CLASS_NUM,), fill_value=WINDOW_NUM, dtype=torch.long).to(device)
-target_lengths = torch.full(size=(QUERY_NUM*CLASS_NUM,), fill_value=1, dtype=torch.long).to(device)
-blank_prob = torch.full(size=(QUERY_NUM*CLASS_NUM, WINDOW_NUM, 1), fill_value=1, dtype=torch.float).to(device)
+input_lengths = torch.full(size=(EPISODE_NUM*QUERY_NUM*CLASS_NUM,), fill_value=WINDOW_NUM, dtype=torch.long).to(device)
+target_lengths = torch.full(size=(EPISODE_NUM*QUERY_NUM*CLASS_NUM,), fill_value=1, dtype=torch.long).to(device)
+blank_prob = torch.full(size=(EPISODE_NUM*QUERY_NUM*CLASS_NUM, WINDOW_NUM, 1), fill_value=1, dtype=torch.float).to(device)
+
+# Mixed Precision
+def autocast():
+    # Forward passes of the models in bfloat16 with --bf16, outputs are cast back to float32 before the softmax and the losses
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16)
+
+# Encoding
+def encode(data):
+    # [video, window*clip, RGB, frame, H, W] -> [video, window*clip, feature]
+    video_num = int(data.shape[0])
+    with autocast():
+        embed = c3d(normalize_clips(data.view(-1, 3, FRAME_NUM, FRAME_SIZE, FRAME_SIZE).to(device, non_blocking=True)))
+        embed = embed.view(video_num, WINDOW_NUM*CLIP_NUM, -1)  # [video, window*clip, feature]
+
+        # TCN Processing
+        embed = torch.transpose(embed, 1, 2)           # [video, feature(channel), window*clip(length)]
+        embed = tcn(embed)
+        embed = torch.transpose(embed, 1, 2)           # [video, window*clip, feature]
+    return embed.float()
+
+# Episode Loaders
+train_dataset = dataset.get_video_dataset(dataset_info, "train", video_index, FRAME_NUM, CLIP_NUM, WINDOW_NUM, SAMPLE_NUM+QUERY_NUM, frame_store, not args.uint8, FRAME_SIZE)
+valid_dataset = dataset.get_video_dataset(dataset_info, "test", video_index, FRAME_NUM, CLIP_NUM, WINDOW_NUM, SAMPLE_NUM+QUERY_NUM, frame_store, not args.uint8, FRAME_SIZE)
+
+# Validation episodes are drawn once and replayed every round, with the same splits
+valid_seed = None if args.split_seed is None else args.split_seed + 1
+valid_sampler = iter(dataset.EpisodicBatchSampler(valid_dataset.video_labels, CLASS_NUM, SAMPLE_NUM+QUERY_NUM, valid_seed))
+valid_list = [next(valid_sampler) for _ in range(args.valid_ep)]
+
+if not args.frozen:
+    train_episodes = iter(dataset.get_episode_loader(train_dataset, CLASS_NUM, SAMPLE_NUM+QUERY_NUM, args.workers, args.prefetch))
+else:
+    # Frozen backbone: every video is encoded once, episodes then index the features directly
+    c3d.eval()
+    tcn.eval()
+    for param in list(c3d.parameters()) + list(tcn.parameters()):
+        param.requires_grad = False
+
+    feature_key = [checkpoint_hash(args.checkpoint), FRAME_SIZE, FRAME_NUM, CLIP_NUM, WINDOW_NUM, args.head, TCN_OUT] + (["bf16"] if args.bf16 else [])
+    train_path = os.path.join(args.feature_store, "train.pt") if args.feature_store is not None else None
+    valid_path = os.path.join(args.feature_store, "test.pt") if args.feature_store is not None else None
+    with torch.no_grad():
+        train_features = load_features(train_path, feature_key, train_dataset, encode, CLASS_NUM*(SAMPLE_NUM+QUERY_NUM), args.workers).to(device)
+        valid_features = load_features(valid_path, feature_key, valid_dataset, encode, CLASS_NUM*(SAMPLE_NUM+QUERY_NUM), args.workers).to(device)
+    train_labels = torch.tensor(train_dataset.video_labels)
+    valid_labels = torch.tensor(valid_dataset.video_labels)
+
+    train_episodes = iter(dataset.EpisodicBatchSampler(train_dataset.video_labels, CLASS_NUM, SAMPLE_NUM+QUERY_NUM))
+
+# Support & Query Splits (validation replays the same splits every round)
+train_splits = iter(EpisodeSplitSchedule(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, seed=args.split_seed))
+valid_splits = iter(EpisodeSplitSchedule(CLASS_NUM, SAMPLE_NUM, QUERY_NUM, args.valid_ep, valid_seed, repeat=True))
 
 # Training Loop
 train_ep = 0
 while train_ep < args.train_ep:
 
-    # Load Data
+    # Load Data, episodes are stacked one after another
     if train_ep % args.load_frq == 0:
-        try:
-            if dataset_info["name"] != "finegym":
-                the_dataset = dataset.StandardDataset(dataset_info["folders"], "train", dataset_info["split"], CLASS_NUM, INST_NUM, FRAME_NUM, CLIP_NUM, WINDOW_NUM)
-            else:
-                the_dataset = dataset.FinegymDataset(dataset_info["folder"], dataset_info["finegym_info"], "train", dataset_info["split"], CLASS_NUM, INST_NUM, FRAME_NUM, CLIP_NUM, WINDOW_NUM)
-            dataloader = dataset.get_data_loader(the_dataset, num_per_class=SAMPLE_NUM+QUERY_NUM, num_workers=0)
-            data, data_labels = dataloader.__iter__().next()     # [class*(support+query), window*clip, RGB, frame, H, W]
-        except Exception:
-            continue
-        data = data.view(-1, 3, FRAME_NUM, 128, 128)
+        episodes = [next(train_episodes) for _ in range(EPISODE_NUM)]
+        if not args.frozen:
+            data = torch.cat([data for data, _ in episodes])                        # [episode*class*(support+query), window*clip, RGB, frame, H, W]
+            data_labels = torch.cat([data_labels for _, data_labels in episodes])
+        else:
+            episode = [idx for episode in episodes for idx in episode]
+            data_labels = torch.cat([dataset.episode_labels(train_labels[episode]) for episode in episodes])
     
     print("Train_Ep[{}] Current_Accuracy = {}".format(train_ep, max_accuracy), end="\t")
     
     # Generate support & query split
-    query_index = []
-    support_index = []
-    for i in range(CLASS_NUM):
-        start = (SAMPLE_NUM+QUERY_NUM) * i
-        end = (SAMPLE_NUM+QUERY_NUM) * (i+1)
-        index = list(range(start, end))
-        q = random.sample(index, QUERY_NUM)
-        s = list(set(index)-set(q))
-        query_index.extend(q)
-        support_index.extend(s)
-    random.shuffle(query_index)
-    query_index = torch.tensor(query_index)
-    support_index = torch.tensor(support_index)
-
-    # Encoding
-    embed = c3d(Variable(data).to(device))
-    embed = embed.view(CLASS_NUM*(SAMPLE_NUM+QUERY_NUM), WINDOW_NUM*CLIP_NUM, -1)  # [class*(support+query), window*clip, feature]
-
-    # TCN Processing
-    embed = torch.transpose(embed, 1, 2)           # [class*(support+query), feature(channel), window*clip(length)]
-    embed = tcn(embed)
-    embed = torch.transpose(embed, 1, 2)           # [class*(support+query), window*clip, feature]
-
-    # Split data into support & query
-    samples = embed[support_index] # [class*support, window*clip, feature]
-    batches = embed[query_index]   # [class*query, window*clip, feature]
-    batches_labels = data_labels[query_index]
-
-    # Attention Pooling
-    samples = samples.reshape(CLASS_NUM*SAMPLE_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [class*sample*window, clip, feature]
-    batches = batches.reshape(CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [query*class*window, clip, feature]
-    samples = ap(samples, batches)                    # [query*class*window, class, clip, feature]
-
-    # Compute Relation
-    batches_rn = batches.unsqueeze(0).repeat(CLASS_NUM,1,1,1)  # [class, query*class*window, clip, feature]
-    batches_rn = torch.transpose(batches_rn,0,1)               # [query*class*window, class, clip, feature]
-    relations = torch.cat((samples,batches_rn),2).reshape(-1,CLIP_NUM*2,TCN_OUT)    # [query*class*window, class, clip*2(channel), feature]
-    relations = rn(relations).reshape(QUERY_NUM*CLASS_NUM, WINDOW_NUM, CLASS_NUM)    # [query*class, window, class]
-    relations_ctc = torch.cat((blank_prob, relations), 2)             # [query*class, window(length), class+1]
-    final_outcome = torch.transpose(logSoftmax(relations_ctc), 0, 1)  # [window(length), query*class, class+1]
+    support_index, query_index = stack_splits([next(train_splits) for _ in range(EPISODE_NUM)], CLASS_NUM*(SAMPLE_NUM+QUERY_NUM))
+
+    # Forward passes, in bfloat16 with --bf16
+    with autocast():
+        # Encoding
+        if not args.frozen:
+            embed = encode(data)                          # [episode*class*(support+query), window*clip, feature]
+        else:
+            embed = train_features[episode]               # [episode*class*(support+query), window*clip, feature]
+
+        # Split data into support & query
+        samples = embed[support_index] # [episode*class*support, window*clip, feature]
+        batches = embed[query_index]   # [episode*class*query, window*clip, feature]
+        batches_labels = data_labels[query_index]
+
+        # Attention Pooling
+        samples = samples.reshape(EPISODE_NUM, CLASS_NUM*SAMPLE_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [episode, class*sample*window, clip, feature]
+        batches = batches.reshape(EPISODE_NUM, CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [episode, query*class*window, clip, feature]
+        samples = ap.forward_episodes(samples, batches)     # [episode, query*class*window, class, clip, feature]
+        samples = samples.reshape(EPISODE_NUM*CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLASS_NUM, CLIP_NUM, -1)  # [episode*query*class*window, class, clip, feature]
+        batches = batches.reshape(EPISODE_NUM*CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)            # [episode*query*class*window, clip, feature]
+
+        # Compute Relation
+        relations = rn.forward_factorized(samples, batches)                                       # [episode*query*class*window*class, 1]
+    relations = relations.float().reshape(EPISODE_NUM*QUERY_NUM*CLASS_NUM, WINDOW_NUM, CLASS_NUM)   # [episode*query*class, window, class]
+    relations_ctc = torch.cat((blank_prob, relations), 2)             # [episode*query*class, window(length), class+1]
+    final_outcome = torch.transpose(logSoftmax(relations_ctc), 0, 1)  # [window(length), episode*query*class, class+1]
 
     if args.mse_also:
-        relations_mse = nn.functional.softmax(torch.sum(relations, 1), dim=1) # [query*class, class]
-        one_hot_labels = Variable(torch.zeros(QUERY_NUM*CLASS_NUM, CLASS_NUM).scatter_(1, (batches_labels-1).view(-1,1), 1).to(device))
+        relations_mse = nn.functional.softmax(torch.sum(relations, 1), dim=1) # [episode*query*class, class]
+        one_hot_labels = Variable(torch.zeros(EPISODE_NUM*QUERY_NUM*CLASS_NUM, CLASS_NUM).scatter_(1, (batches_labels-1).view(-1,1), 1).to(device))
         loss = mse(relations_mse, one_hot_labels) + ctc(final_outcome, batches_labels, input_lengths, target_lengths)
     else:
         loss = ctc(final_outcome, batches_labels, input_lengths, target_lengths)
@@ -208,20 +280,23 @@ while train_ep < args.train_ep:
     loss.backward()
 
     # Clip Gradient
-    nn.utils.clip_grad_norm_(c3d.parameters(),0.5)
-    nn.utils.clip_grad_norm_(tcn.parameters(),0.5)
+    if not args.frozen:
+        nn.utils.clip_grad_norm_(c3d.parameters(),0.5)
+        nn.utils.clip_grad_norm_(tcn.parameters(),0.5)
     nn.utils.clip_grad_norm_(ap.parameters(),0.5)
     nn.utils.clip_grad_norm_(rn.parameters(),0.5)
 
-    # Update Models
-    c3d_optim.step()
-    tcn_optim.step()
+    # Update Models, a frozen C3D and TCN have neither gradients nor optimizer steps
+    if not args.frozen:
+        c3d_optim.step()
+        tcn_optim.step()
     rn_optim.step()
     ap_optim.step()
 
     # Update "step" for scheduler
-    c3d_scheduler.step()
-    tcn_scheduler.step()
+    if not args.frozen:
+        c3d_scheduler.step()
+        tcn_scheduler.step()
     ap_scheduler.step()
     rn_scheduler.step()
 
@@ -230,79 +305,81 @@ while train_ep < args.train_ep:
     # Validation Loop
     if (train_ep % args.valid_frq == 0 and train_ep != 0) or train_ep == args.train_ep:
 
-        with torch.no_grad():
+        # Running statistics and no dropout, so that a round only depends on the weights
+        c3d.eval()
+        tcn.eval()
+        ap.eval()
+        rn.eval()
+
+        # The validation loader is built for each pass and its workers are shut down at the end of it,
+        # so that they hold no episodes during training
+        if args.frozen:
+            valid_episodes = iter(valid_list)
+        else:
+            valid_episodes = iter(dataset.get_episode_loader(valid_dataset, CLASS_NUM, SAMPLE_NUM+QUERY_NUM, args.workers, args.prefetch, valid_list))
+
+        with torch.no_grad(), autocast():
             accuracies = []
 
             valid_ep = 0
             while valid_ep < args.valid_ep:
 
-                # Data Loading
-                try:
-                    if DATASET in ['haa', 'mit']:
-                        the_dataset = dataset.StandardDataset(DATA_FOLDERS, "test", (TRAIN_SPLIT, VAL_SPLIT, TEST_SPLIT), CLASS_NUM, INST_NUM, FRAME_NUM, CLIP_NUM, WINDOW_NUM)
-                    elif DATASET in ['finegym']:
-                        the_dataset = dataset.FinegymDataset(DATA_FOLDERS, INFO_DICT, "test", [TRAIN_SPLIT, VAL_SPLIT, TEST_SPLIT], CLASS_NUM, INST_NUM, FRAME_NUM, CLIP_NUM, WINDOW_NUM)
-                    sample_dataloader = dataset.get_data_loader(the_dataset, num_per_class=SAMPLE_NUM, num_workers=0)
-                    batch_dataloader = dataset.get_data_loader(the_dataset, num_per_class=QUERY_NUM,shuffle=True, num_workers=0)
-                    samples, _ = sample_dataloader.__iter__().next()            # [query*class, clip, RGB, frame, H, W]
-                    batches, batches_labels = batch_dataloader.__iter__().next()   # [query*class, window*clip, RGB, frame, H, W]
-                except Exception:
-                    continue
-                
-                print("Val_Ep[{}] Pres_Accu = {}".format(valid_ep, max_accuracy), end="\t")
+                episode_num = min(EPISODE_NUM, args.valid_ep - valid_ep)
+                episode_size = CLASS_NUM*(SAMPLE_NUM+QUERY_NUM)
 
-                # Encoding
-                samples = samples.view(CLASS_NUM*SAMPLE_NUM*WINDOW_NUM*CLIP_NUM, 3, FRAME_NUM, 128, 128)
-                samples = c3d(Variable(samples).to(device))
-                samples = samples.view(CLASS_NUM*SAMPLE_NUM, WINDOW_NUM*CLIP_NUM, -1)    # [support*class, window*clip, feature]
+                # Generate support & query split
+                support_index, query_index = stack_splits([next(valid_splits) for _ in range(episode_num)], episode_size)
 
-                batches = batches.view(CLASS_NUM*QUERY_NUM*WINDOW_NUM*CLIP_NUM, 3, FRAME_NUM, 128, 128)
-                batches = c3d(Variable(batches).to(device))
-                batches = batches.view(CLASS_NUM*QUERY_NUM, WINDOW_NUM*CLIP_NUM,-1)       # [query*class, window*clip, feature]
+                # Data Loading
+                episodes = [next(valid_episodes) for _ in range(episode_num)]
 
-                # TCN Processing
-                samples = torch.transpose(samples,1,2)       # [support*class, feature(channel), window*clip(length)]
-                samples = tcn(samples)
-                samples = torch.transpose(samples,1,2)       # [support*class, window*clip, feature]
-                samples = samples.reshape(CLASS_NUM*SAMPLE_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [class*sample*window, clip, feature]
+                print("Val_Ep[{}] Pres_Accu = {}".format(valid_ep, max_accuracy), end="\t")
 
-                batches = torch.transpose(batches,1,2)       # [query*class, feature(channel), window*clip(length)]
-                batches = tcn(batches)
-                batches = torch.transpose(batches,1,2)       # [query*class, window*clip, feature]
-                batches = batches.reshape(CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [query*class*window, clip, feature]
+                # Encoding, the training episode in data is kept for the next --load_frq episodes
+                if args.frozen:
+                    embed = valid_features[[idx for episode in episodes for idx in episode]]   # [episode*class*(support+query), window*clip, feature]
+                    valid_data_labels = torch.cat([dataset.episode_labels(valid_labels[episode]) for episode in episodes])
+                else:
+                    valid_data = torch.cat([data for data, _ in episodes])                  # [episode*class*(support+query), window*clip, RGB, frame, H, W]
+                    valid_data_labels = torch.cat([data_labels for _, data_labels in episodes])
+                    embed = encode(valid_data)                                              # [episode*class*(support+query), window*clip, feature]
+
+                # Split data into support & query
+                samples = embed[support_index].reshape(episode_num, CLASS_NUM*SAMPLE_NUM*WINDOW_NUM, CLIP_NUM, -1)  # [episode, class*sample*window, clip, feature]
+                batches = embed[query_index].reshape(episode_num, CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)     # [episode, query*class*window, clip, feature]
+                batches_labels = valid_data_labels[query_index]
 
                 # Attention Pooling
-                samples = ap(samples, batches)                    # [query*class*window, class, clip, feature]
+                samples = ap.forward_episodes(samples, batches)     # [episode, query*class*window, class, clip, feature]
+                samples = samples.reshape(episode_num*CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLASS_NUM, CLIP_NUM, -1)  # [episode*query*class*window, class, clip, feature]
+                batches = batches.reshape(episode_num*CLASS_NUM*QUERY_NUM*WINDOW_NUM, CLIP_NUM, -1)            # [episode*query*class*window, clip, feature]
 
                 # Compute Relation
-                batches_rn = batches.unsqueeze(0).repeat(CLASS_NUM,1,1,1)  # [class, query*class*window, clip, feature]
-                batches_rn = torch.transpose(batches_rn,0,1)               # [query*class*window, class, clip, feature]
-                relations = torch.cat((samples,batches_rn),2).reshape(-1,CLIP_NUM*2,TCN_OUT)    # [query*class*window, class, clip*2(channel), feature]
-                relations = rn(relations).reshape(QUERY_NUM*CLASS_NUM, WINDOW_NUM, CLASS_NUM)    # [query*class, window, class]
+                relations = rn.forward_factorized(samples, batches)                                       # [episode*query*class*window*class, 1]
+                relations = relations.float().reshape(episode_num*QUERY_NUM*CLASS_NUM, WINDOW_NUM, CLASS_NUM)   # [episode*query*class, window, class]
 
                 # Generate final probabilities
-                relations_ctc = torch.cat((blank_prob, relations), 2)
-                final_outcome = nn.functional.softmax(relations_ctc, 2)  # [query*class, window(length), class+1]
+                relations_ctc = torch.cat((blank_prob[:episode_num*QUERY_NUM*CLASS_NUM], relations), 2)
+                final_outcome = nn.functional.softmax(relations_ctc, 2)  # [episode*query*class, window(length), class+1]
 
                 # Predict
                 batches_labels = batches_labels.numpy()
                 if args.predict == "mse":
-                    relations_mse = nn.functional.softmax(torch.sum(relations, 1), dim=1) # [query*class, class]
+                    relations_mse = nn.functional.softmax(torch.sum(relations, 1), dim=1) # [episode*query*class, class]
                     _, predict_labels = torch.max(relations_mse.data, 1)
                     batches_labels = batches_labels - 1
                 else:
-                    predict_labels = ctc_predict(final_outcome.cpu().numpy())
                     predict_labels = ctc_predict_single(final_outcome)
 
                 rewards = [1 if predict_labels[i] == batches_labels[i] else 0 for i in range(len(predict_labels))]
-                total_rewards = np.sum(rewards)
 
-                # Record accuracy
-                accuracy = total_rewards/(CLASS_NUM * QUERY_NUM)
-                accuracies.append(accuracy)
-                print("Accuracy = {}".format(accuracy))
+                # Record accuracy of every episode
+                episode_accuracies = np.mean(np.reshape(rewards, (episode_num, CLASS_NUM*QUERY_NUM)), 1)
+                accuracies.extend(episode_accuracies)
+                print("Accuracy = {}".format(np.mean(episode_accuracies)))
 
-                valid_ep += 1
+                valid_ep += episode_num
+            del valid_episodes
 
             # Average accuracy
             val_accuracy, _ = mean_confidence_interval(accuracies)
@@ -326,15 +403,24 @@ while train_ep < args.train_ep:
             torch.save(tcn.state_dict(), os.path.join(folder_for_this_accuracy, "tcn.pkl"))
             torch.save(ap.state_dict(), os.path.join(folder_for_this_accuracy, "ap.pkl"))
 
-            torch.save(c3d_optim.state_dict(), os.path.join(folder_for_this_accuracy, "c3d_optim.pkl"))
+            # The optimizer and scheduler of a frozen C3D and TCN never change, a later run starts them anew
+            if not args.frozen:
+                torch.save(c3d_optim.state_dict(), os.path.join(folder_for_this_accuracy, "c3d_optim.pkl"))
+                torch.save(tcn_optim.state_dict(), os.path.join(folder_for_this_accuracy, "tcn_optim.pkl"))
             torch.save(rn_optim.state_dict(), os.path.join(folder_for_this_accuracy, "rn_optim.pkl"))
-            torch.save(tcn_optim.state_dict(), os.path.join(folder_for_this_accuracy, "tcn_optim.pkl"))
             torch.save(ap_optim.state_dict(), os.path.join(folder_for_this_accuracy, "ap_optim.pkl"))
 
-            torch.save(c3d_scheduler.state_dict(), os.path.join(folder_for_this_accuracy, "c3d_scheduler.pkl"))
+            if not args.frozen:
+                torch.save(c3d_scheduler.state_dict(), os.path.join(folder_for_this_accuracy, "c3d_scheduler.pkl"))
+                torch.save(tcn_scheduler.state_dict(), os.path.join(folder_for_this_accuracy, "tcn_scheduler.pkl"))
             torch.save(rn_scheduler.state_dict(), os.path.join(folder_for_this_accuracy, "rn_scheduler.pkl"))
-            torch.save(tcn_scheduler.state_dict(), os.path.join(folder_for_this_accuracy, "tcn_scheduler.pkl"))
             torch.save(ap_scheduler.state_dict(), os.path.join(folder_for_this_accuracy, "ap_scheduler.pkl"))
 
+        if not args.frozen:
+            c3d.train()
+            tcn.train()
+        ap.train()
+        rn.train()
+
 print("Training Done")
 print("Final Accuracy = {}".format(max_accuracy))
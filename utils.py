@@ -10,6 +10,76 @@ def mean_confidence_interval(data, confidence=0.95):
     h = se * scipy.stats.t._ppf((1+confidence)/2., n-1)
     return m,h
 
+# Clips shipped as uint8 by the datasets are mapped to -1 to 1 on the computing device
+def normalize_clips(clips):
+    if clips.dtype == torch.uint8:
+        return clips.float().div_(127.5).sub_(1)
+    return clips
+
+# Support/query splits of many episodes at once, each class of an episode owns <support_num+query_num> consecutive
+# items, a random permutation per class picks its queries, then the queries of an episode are shuffled together
+def episode_splits(episode_num, class_num, support_num, query_num, generator=None):
+    inst_num = support_num + query_num
+    perm = torch.rand(episode_num, class_num, inst_num, generator=generator).argsort(2)     # [episode, class, inst]
+    perm = perm + torch.arange(class_num).view(1, -1, 1) * inst_num
+
+    support_index = perm[:, :, query_num:].sort(2)[0].reshape(episode_num, -1)             # [episode, class*support]
+    query_index = perm[:, :, :query_num].reshape(episode_num, -1)                            # [episode, class*query]
+    query_index = query_index.gather(1, torch.rand(query_index.shape, generator=generator).argsort(1))
+    return support_index, query_index
+
+# Splits are generated in blocks of <episode_num> episodes, a saved schedule is replayed as is for reproducible runs
+# The seed is kept, also when drawn at random, so that the episodes of a replayed run can be seeded from it as well
+class EpisodeSplitSchedule(object):
+
+    def __init__(self, class_num, support_num, query_num, episode_num=1000, seed=None, repeat=False):
+        self.class_num = class_num
+        self.support_num = support_num
+        self.query_num = query_num
+        self.episode_num = episode_num
+        self.repeat = repeat
+
+        self.generator = torch.Generator()
+        if seed is None:
+            self.seed = self.generator.seed()
+        else:
+            self.seed = seed
+            self.generator.manual_seed(seed)
+        self.support_index, self.query_index = episode_splits(episode_num, class_num, support_num, query_num, self.generator)
+
+    def __len__(self):
+        return self.episode_num
+
+    def __getitem__(self, ep):
+        return self.support_index[ep], self.query_index[ep]
+
+    def __iter__(self):
+        while True:
+            for ep in range(self.episode_num):
+                yield self.support_index[ep], self.query_index[ep]
+            if not self.repeat:
+                self.support_index, self.query_index = episode_splits(self.episode_num, self.class_num, self.support_num, self.query_num, self.generator)
+
+    def save(self, path):
+        torch.save({"support_num": self.support_num, "query_num": self.query_num, "support_index": self.support_index, "query_index": self.query_index,
+                    "seed": self.seed}, path)
+
+    @staticmethod
+    def load(path):
+        state = torch.load(path)
+        episode_num, class_num = state["query_index"].shape[0], state["query_index"].shape[1] // state["query_num"]
+        schedule = EpisodeSplitSchedule(class_num, state["support_num"], state["query_num"], 1, repeat=True)
+        schedule.episode_num = episode_num
+        schedule.support_index, schedule.query_index = state["support_index"], state["query_index"]
+        schedule.seed = state.get("seed")
+        return schedule
+
+# Splits of E episodes stacked one after another, each <episode_size> items long, as global indices
+def stack_splits(splits, episode_size):
+    support_index = torch.cat([support_index + e * episode_size for e, (support_index, _) in enumerate(splits)])
+    query_index = torch.cat([query_index + e * episode_size for e, (_, query_index) in enumerate(splits)])
+    return support_index, query_index
+
 def ndarray_equal(arr1, arr2):
     return len(arr1) == len(arr2) and np.count_nonzero((arr1 == arr2) == True) == len(arr1)
 
@@ -64,53 +134,21 @@ def ctc_length_mask(input):
     
     return lengths, mask
 
-from ctc.ctc_loss import ctcLabelingProb as ctc_prob
-from string import ascii_letters as letters
+from ctc.ctc_batch import ctc_log_likelihood, pad_targets
 # Truth label start with 1
 # 0-th of prob is blank label
 def ctc_probability(prob, truth):
-    C = int(prob.shape[1])
-    C -= 1
-    assert C <= 27
-
-    classes = [letters[i] for i in range(C)]
-    classes = "".join(classes)
-
-    gt = truth - 1
-    gt = [letters[i] for i in gt]
-
-    blank = prob[:, 0]
-    blank = blank.unsqueeze(1)
-    non_blank = prob[:, 1:]
-    mat = torch.cat((non_blank, blank), 1)
-
-    return ctc_prob(mat, gt, classes)
+    truth = torch.as_tensor(np.asarray(truth), dtype=torch.long).view(1, -1)
+    log_prob = ctc_log_likelihood(torch.log(prob).unsqueeze(0), truth, [truth.shape[1]])
+    return float(log_prob.exp())
 
 def ctc_alignment_predict(probs, targets, target_lengths, sample_num):
-    N, W, CL = int(probs.shape[0]), int(probs.shape[1]), int(probs.shape[2])
-    CL -= 1
-    S = int(target_lengths.shape[0])
+    # Every query against every concatenated target at once, targets of one class come in groups of sample_num
+    padded, target_lengths = pad_targets(targets, target_lengths)
+    log_probs = ctc_log_likelihood(torch.log(probs.double()), padded, target_lengths)   # [query, target]
 
-    result = probs.new_full((N, ), fill_value=0, dtype=torch.int, requires_grad=False)
-    
-    for n in range(N):
-        prediction_probs = target_lengths.new_full((S, ), fill_value=0, dtype=torch.double, requires_grad=False)
-        
-        start = 0
-        for s in range(S):
-            length = int(target_lengths[s])
-            prediction_probs[s] = ctc_probability(probs[n], targets[start: start+length])
-            # file = open("test.log", "a")
-            # file.write("prob from "+str(probs[n])+" to "+str(targets[start: start+length])+"\n")
-            # file.close()
-            start += length
-        
-        # print("\nprediction_probs", prediction_probs, "\n")
-        _, result[n] = torch.max(prediction_probs, 0)
-    
-    result = [int(result[i]//sample_num)+1 for i in range(len(result))]
-
-    return result
+    result = torch.argmax(log_probs, 1) // sample_num + 1
+    return result.tolist()
 
 def PCA(X, k=2):
     X_mean = torch.mean(X, 0)
@@ -119,31 +157,25 @@ def PCA(X, k=2):
     U,S,V = torch.svd(torch.t(X))
     return torch.mm(X,U[:,:k])
 
-from ctc.ctc_decode import decode as ctc_decode
-def ctc_predict(input):
-    results = []
-    for i in range(len(input)):
-        result, _ = ctc_decode(input[i])
-        results.append(result)
-    return results
+from ctc.ctc_decode import decode_batch as ctc_decode_batch
+def ctc_predict(input, beam_size=100):
+    # Decode all queries together, [batch, window, class+1] -> label sequences
+    return [result for result, _ in ctc_decode_batch(input, beam_size)]
 
 def ctc_predict_single(input):
     N, W, C = input.shape # Batch, Window, Class
     C -= 1
 
-    prediction = []
-    for n in range(N):
-        prob = input[n]
-        results = []
-        for c in range(C):
-            truth = np.array([c+1])
-            results.append(ctc_probability(prob, truth))
-        prediction.append(results)
-    
-    prediction = np.argmax(prediction, axis=1) + 1
-    return prediction
+    # Score every query against every single class label at once
+    truth = torch.arange(1, C+1, device=input.device).view(C, 1)
+    lengths = torch.ones(C, dtype=torch.long, device=input.device)
+    log_probs = ctc_log_likelihood(torch.log(input), truth, lengths)   # [batch, class]
+
+    prediction = torch.argmax(log_probs, 1) + 1
+    return prediction.cpu().numpy()
 
-def my_load(model, name):
-    model_path = os.path.join(args.checkpoint, name)
-    if os.path.join(model_path):
-        model.load_state_dict(torch.load(model_path))
\ No newline at end of file
+# Checkpoints saved on a GPU are mapped to <map_location> when loaded elsewhere, e.g. on a CPU node
+def my_load(model, name, checkpoint, map_location=None):
+    model_path = os.path.join(checkpoint, name)
+    if os.path.exists(model_path):
+        model.load_state_dict(torch.load(model_path, map_location=map_location))
\ No newline at end of file
@@ -0,0 +1,112 @@
+# Public Packages
+import json                                          #
+import os                                            #  OS
+
+INDEX_SUFFIX = ".index.json"
+
+# A video index maps every class to its videos as [video_folder, frame_count, sorted frame names].
+# The mtime of every listed folder is recorded, adding or removing a frame, a video or a class
+# changes the mtime of its parent folder, so comparing mtimes is enough to find a stale index.
+
+def index_path(dataset_path):
+    return os.path.splitext(dataset_path)[0] + INDEX_SUFFIX
+
+def dataset_sources(dataset_info):
+    if dataset_info["name"] != "finegym":
+        return list(dataset_info["folders"])
+    return [dataset_info["folder"]]
+
+class VideoIndex(object):
+
+    def __init__(self, sources, classes, mtimes):
+        self.sources = sources
+        self.classes = classes
+        self.mtimes = mtimes
+
+        self.frames = dict()
+        for videos in self.classes.values():
+            for video_folder, _, frame_names in videos:
+                self.frames[video_folder] = frame_names
+
+    def __contains__(self, video_folder):
+        return video_folder in self.frames
+
+    def class_names(self):
+        return list(self.classes.keys())
+
+    def videos(self, class_name, min_frame_num=0):
+        return [video_folder for video_folder, frame_count, _ in self.classes.get(class_name, []) if frame_count >= min_frame_num]
+
+    def frame_names(self, video_folder):
+        return self.frames[video_folder]
+
+    def is_stale(self, sources=None):
+        if sources is not None and list(sources) != self.sources:
+            return True
+        for folder, mtime in self.mtimes.items():
+            try:
+                if os.path.getmtime(folder) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def save(self, path):
+        with open(path, "w") as file:
+            file.write(json.dumps({"sources": self.sources, "classes": self.classes, "mtimes": self.mtimes}))
+
+    @staticmethod
+    def load(path):
+        with open(path, "r") as file:
+            index = json.loads(file.read())
+        return VideoIndex(index["sources"], index["classes"], index["mtimes"])
+
+def scan_video(video_folder, mtimes):
+    mtimes[video_folder] = os.path.getmtime(video_folder)
+    frame_names = sorted(os.listdir(video_folder))
+    return [video_folder, len(frame_names), frame_names]
+
+def build_video_index(dataset_info):
+    classes = dict()
+    mtimes = dict()
+
+    if dataset_info["name"] != "finegym":
+        for data_folder in dataset_info["folders"]:
+            if not os.path.isdir(data_folder):
+                continue
+            mtimes[data_folder] = os.path.getmtime(data_folder)
+
+            for class_name in sorted(os.listdir(data_folder)):
+                class_folder = os.path.join(data_folder, class_name)
+                if not os.path.isdir(class_folder):
+                    continue
+                mtimes[class_folder] = os.path.getmtime(class_folder)
+
+                videos = classes.setdefault(class_name, [])
+                for video_name in sorted(os.listdir(class_folder)):
+                    video_folder = os.path.join(class_folder, video_name)
+                    if os.path.isdir(video_folder):
+                        videos.append(scan_video(video_folder, mtimes))
+    else:
+        data_folder = dataset_info["folder"]
+        mtimes[data_folder] = os.path.getmtime(data_folder)
+
+        for class_name, video_names in dataset_info["finegym_info"].items():
+            videos = classes.setdefault(class_name, [])
+            for video_name in video_names:
+                video_folder = os.path.join(data_folder, video_name)
+                if os.path.isdir(video_folder):
+                    videos.append(scan_video(video_folder, mtimes))
+
+    return VideoIndex(dataset_sources(dataset_info), classes, mtimes)
+
+def load_video_index(path, dataset_info, rebuild=False):
+    # Reuse the saved index unless any indexed folder changed since it was built
+    if not rebuild and os.path.exists(path):
+        video_index = VideoIndex.load(path)
+        if not video_index.is_stale(dataset_sources(dataset_info)):
+            return video_index
+
+    video_index = build_video_index(dataset_info)
+    video_index.save(path)
+    return video_index